@@ -1,5 +1,14 @@
+import hashlib
+import inspect
 import json
+import numpy as np
+import os
+import pickle
 import pandas as pd
+from abc import ABC, abstractmethod
+from datetime import datetime
+from multiprocessing import Pool
+from scripts.jsonl_io import open_jsonl, loads, compression_of
 import matplotlib.pyplot as plt
 
 def plot_histogram(data, title, xlabel, ylabel='Frequency', bins=40, figsize=(10, 6)):
@@ -26,50 +35,398 @@ def plot_horizontal_bar(data, title, xlabel, top_n=10, figsize=(12, 8), ascendin
     plt.tight_layout()
     plt.show()
 
-def analyze_sentiment(file_path, min_count=100):
-    tag_dict = {}
+class Accumulator(ABC):
+    '''
+    A metric computed by `run_metrics`. Each worker starts from `zero()`, feeds every post to `add`
+    and partial states are combined with `merge`, so states must be picklable and merging associative.
+    '''
+    name = None
+    version = 1 #Bump when the metric's logic changes, so cached partial results are recomputed
+    result_params = () #Attributes only used by `result`, which do not change the partial states
 
-    with open(file_path, 'r') as f:
-        for line in f:
+    @abstractmethod
+    def zero(self):
+        'A new, empty state'
+
+    @abstractmethod
+    def add(self, state, post):
+        'Updates the state in place with one post'
+
+    @abstractmethod
+    def merge(self, a, b):
+        'Combines two states, returning the result (a may be modified)'
+
+    def result(self, state):
+        return state
+
+METRICS = {}
+
+def register_metric(cls):
+    'Class decorator making a metric available by name. Incomplete metrics fail here, not inside a worker'
+    if inspect.isabstract(cls):
+        raise TypeError(f'{cls.__name__} does not implement {", ".join(sorted(cls.__abstractmethods__))}')
+    if not cls.name:
+        raise TypeError(f'{cls.__name__} has no name')
+    METRICS[cls.name] = cls
+    return cls
+
+def merge_counters(a: dict, b: dict):
+    'Merges dicts of equal-length lists of numbers by elementwise sums'
+    for k, v in b.items():
+        if k in a:
+            a[k] = [x + y for x, y in zip(a[k], v)]
+        else:
+            a[k] = v
+    return a
+
+def post_sentiments(post):
+    'Sentiment of the question, its answers and every comment, skipping missing ones'
+    sentiments = [post.get('body_sentiment')]
+    sentiments += [c.get('text_sentiment') for c in post.get('comments', [])]
+    for answer in post.get('answers', []):
+        sentiments.append(answer.get('body_sentiment'))
+        sentiments += [c.get('text_sentiment') for c in answer.get('comments', [])]
+    return [s for s in sentiments if s is not None]
+
+@register_metric
+class TagSentiment(Accumulator):
+    'Per tag: [number of posts, sum of thread minimum sentiments, sum of thread average sentiments]'
+    name = 'tag_sentiment'
+
+    def zero(self):
+        return {}
+
+    def add(self, state, post):
+        sentiments = post_sentiments(post)
+        if not sentiments:
+            return
+        minimum, average = min(sentiments), sum(sentiments) / len(sentiments)
+        for tag in post.get('tags', []):
+            counts = state.setdefault(tag, [0, 0, 0.0])
+            counts[0] += 1
+            counts[1] += minimum
+            counts[2] += average
+
+    def merge(self, a, b):
+        return merge_counters(a, b)
+
+@register_metric
+class YearlySentiment(Accumulator):
+    'Per year and kind (posts, answers, post_comments, answer_comments): [count, sentiment sum]'
+    name = 'yearly_sentiment'
+
+    def zero(self):
+        return {}
+
+    def add(self, state, post):
+        def count(obj, key, kind):
+            if obj.get(key) is not None:
+                counts = state.setdefault((int(obj['creation_date'][:4]), kind), [0, 0])
+                counts[0] += 1
+                counts[1] += obj[key]
+
+        count(post, 'body_sentiment', 'posts')
+        for c in post['comments']:
+            count(c, 'text_sentiment', 'post_comments')
+        for a in post['answers']:
+            count(a, 'body_sentiment', 'answers')
+            for c in a['comments']:
+                count(c, 'text_sentiment', 'answer_comments')
+
+    def merge(self, a, b):
+        return merge_counters(a, b)
+
+@register_metric
+class TagPolarity(Accumulator):
+    'Per (tag, field): [positives, negatives], like cs_rq3. Fields are body, body_answer, comments and comments_answer'
+    name = 'tag_polarity'
+
+    def zero(self):
+        return {}
+
+    def add(self, state, post):
+        def count(sentiment, field):
+            if sentiment is None or sentiment == 1:
+                return
+            for tag in post['tags']:
+                counts = state.setdefault((tag, field), [0, 0])
+                counts[0 if sentiment == 2 else 1] += 1
+
+        count(post.get('body_sentiment'), 'body')
+        for a in post['answers']:
+            count(a.get('body_sentiment'), 'body_answer')
+            for c in a['comments']:
+                count(c.get('text_sentiment'), 'comments_answer')
+        for c in post['comments']:
+            count(c.get('text_sentiment'), 'comments')
+
+    def merge(self, a, b):
+        return merge_counters(a, b)
+
+@register_metric
+class ResponseTimes(Accumulator):
+    '''
+    Per question sentiment, like rq2: total and unanswered questions, and the hours until the first answer
+    of every answered question (in file order).
+    '''
+    name = 'response_times'
+
+    def zero(self):
+        return {'total': [0, 0, 0], 'unanswered': [0, 0, 0], 'response_times': [[], [], []]}
+
+    def add(self, state, post):
+        sent = post.get('body_sentiment')
+        if sent is None:
+            return
+        state['total'][sent] += 1
+        if not post['answers']:
+            state['unanswered'][sent] += 1
+        else:
+            first = min(datetime.fromisoformat(a['creation_date']) for a in post['answers'])
+            state['response_times'][sent].append((first - datetime.fromisoformat(post['creation_date'])).total_seconds() / 3600)
+
+    def merge(self, a, b):
+        return {'total': [x + y for x, y in zip(a['total'], b['total'])],
+                'unanswered': [x + y for x, y in zip(a['unanswered'], b['unanswered'])],
+                'response_times': [x + y for x, y in zip(a['response_times'], b['response_times'])]}
+
+@register_metric
+class UserSentiment(Accumulator):
+    '''
+    Per user id: [count, sentiment sum, minimum sentiment] over everything they posted (questions, answers
+    and comments), like helper.get_users_sentiment_stats. The result has the same dict of arrays, sorted by user.
+    '''
+    name = 'user_sentiment'
+    result_params = ('minimum_posts',)
+
+    def __init__(self, minimum_posts=1):
+        self.minimum_posts = minimum_posts
+
+    def zero(self):
+        return {}
+
+    def add(self, state, post):
+        def count(user, sentiment):
+            if user is None or sentiment is None:
+                return
+            stats = state.get(user)
+            if stats is None:
+                state[user] = [1, sentiment, sentiment]
+            else:
+                stats[0] += 1
+                stats[1] += sentiment
+                stats[2] = min(stats[2], sentiment)
+
+        for p in [post] + post['answers']:
+            count(p.get('owner_user_id'), p.get('body_sentiment'))
+            for c in p['comments']:
+                count(c.get('user_id'), c.get('text_sentiment'))
+
+    def merge(self, a, b):
+        for user, (n, total, minimum) in b.items():
+            stats = a.get(user)
+            if stats is None:
+                a[user] = [n, total, minimum]
+            else:
+                a[user] = [stats[0] + n, stats[1] + total, min(stats[2], minimum)]
+        return a
+
+    def result(self, state):
+        users = sorted(u for u, stats in state.items() if stats[0] >= self.minimum_posts)
+        counts = np.array([state[u][0] for u in users], dtype=np.int64)
+        return {'user': np.array(users, dtype=np.int64), 'count': counts,
+                'mean': np.array([state[u][1] for u in users], dtype=np.float64) / np.maximum(counts, 1),
+                'min': np.array([state[u][2] for u in users], dtype=np.int8)}
+
+def chunk_ranges(path, chunk_bytes):
+    'Splits a file into byte ranges of about chunk_bytes, each starting at the beginning of a line'
+    if compression_of(path) is not None:
+        return [(0, None)] #Compressed streams cannot seek, they are read as a single chunk
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_bytes, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def empty_report(metrics):
+    return {'lines': 0, 'malformed': 0, 'malformed_offsets': [], 'metric_errors': {m.name: 0 for m in metrics}}
+
+def run_chunk(job):
+    'Worker side of run_metrics: feeds the lines of one byte range (until the end of the file if end is None) to every metric'
+    path, start, end, metrics = job
+    states, report = [m.zero() for m in metrics], empty_report(metrics)
+
+    with open_jsonl(path, 'rb') as f:
+        if start:
+            f.seek(start)
+        pos = start
+        while end is None or pos < end:
+            line = f.readline()
+            if not line:
+                break
+            offset, pos = pos, pos + len(line)
+            report['lines'] += 1
             try:
-                post = json.loads(line)
-                
-                sentiments = []
-                if 'body_sentiment' in post:
-                    sentiments.append(post['body_sentiment'])
-                
-                if 'comments' in post:
-                    for comment in post['comments']:
-                        if 'text_sentiment' in comment:
-                            sentiments.append(comment['text_sentiment'])
-                
-                if 'answers' in post:
-                    for answer in post['answers']:
-                        if 'body_sentiment' in answer:
-                            sentiments.append(answer['body_sentiment'])
-                        if 'comments' in answer:
-                            for comment in answer['comments']:
-                                if 'text_sentiment' in comment:
-                                    sentiments.append(comment['text_sentiment'])
-                
-                if not sentiments:
-                    continue
-                    
-                minimum_sentiment = min(sentiments)
-                average_sentiment = sum(sentiments) / len(sentiments)
-                
-                if 'tags' in post:
-                    for tag in post['tags']:
-                        if tag not in tag_dict:
-                            tag_dict[tag] = {'count': 1, 'minimum_sentiment': minimum_sentiment, 'average_sentiment': average_sentiment}
-                        else:
-                            tag_dict[tag]['minimum_sentiment'] += minimum_sentiment
-                            tag_dict[tag]['average_sentiment'] += average_sentiment
-                            tag_dict[tag]['count'] += 1
-
-            except:
+                post = loads(line)
+                if not isinstance(post, dict):
+                    raise ValueError('not an object')
+            except ValueError:
+                report['malformed'] += 1
+                report['malformed_offsets'].append(offset)
                 continue
 
+            for m, state in zip(metrics, states):
+                try:
+                    m.add(state, post)
+                except (KeyError, TypeError, ValueError, IndexError):
+                    report['metric_errors'][m.name] += 1
+
+    return states, report
+
+def merge_reports(a, b):
+    return {'lines': a['lines'] + b['lines'], 'malformed': a['malformed'] + b['malformed'],
+            'malformed_offsets': (a['malformed_offsets'] + b['malformed_offsets'])[:100],
+            'metric_errors': {k: a['metric_errors'][k] + b['metric_errors'][k] for k in a['metric_errors']}}
+
+def run_metrics(file_path, metrics, workers=1, chunk_bytes=64 * 1024 * 1024):
+    '''
+    Computes every metric (Accumulator instances or registered names) in a single pass over the file,
+    split in chunks processed by `workers` processes. Returns ({name: result}, report), where the report
+    counts lines, malformed lines (with the byte offsets of the first ones) and posts each metric failed on.
+    '''
+    metrics = [METRICS[m]() if isinstance(m, str) else m for m in metrics]
+    jobs = [(file_path, start, end, metrics) for start, end in chunk_ranges(file_path, chunk_bytes)]
+
+    states, report = [m.zero() for m in metrics], empty_report(metrics)
+    def combine(partial):
+        nonlocal states, report
+        part_states, part_report = partial
+        states = [m.merge(a, b) for m, a, b in zip(metrics, states, part_states)]
+        report = merge_reports(report, part_report)
+
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers) as pool:
+            for partial in pool.imap(run_chunk, jobs): #Ordered, so list-valued results keep file order
+                combine(partial)
+    else:
+        for job in jobs:
+            combine(run_chunk(job))
+
+    return {m.name: m.result(s) for m, s in zip(metrics, states)}, report
+
+def print_report(report):
+    print(f"Read {report['lines']} lines, {report['malformed']} malformed")
+    if report['malformed_offsets']:
+        print(f"  First malformed lines at byte offsets: {report['malformed_offsets'][:10]}")
+    for name, errors in report['metric_errors'].items():
+        if errors:
+            print(f"  {name}: failed on {errors} posts")
+
+def metric_key(metric):
+    'Identifies the partial states of a metric: its name, version and the parameters they depend on'
+    params = sorted((k, v) for k, v in vars(metric).items() if k not in metric.result_params)
+    definition = f"{metric.name}:{metric.version}:{params}"
+    return hashlib.blake2b(definition.encode(), digest_size=8).hexdigest()
+
+def partition_hash(path, hashes):
+    '''
+    Content hash of a partition file. `hashes` remembers (size, mtime) -> hash per path,
+    so unchanged files are not read again.
+    '''
+    stat = os.stat(path)
+    known = hashes.get(os.path.abspath(path))
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[2]
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    hashes[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+def atomic_write(path, data: bytes):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+def run_metrics_cached(paths, metrics, cache_dir='./analysis-cache', workers=1, chunk_bytes=64 * 1024 * 1024):
+    '''
+    Like run_metrics over several partition files (e.g. the per-year shards of converter.py), caching every
+    partition's partial state of every metric in `cache_dir`, keyed by the partition's content hash and the
+    metric definition. Only new or changed partitions (or new metrics) are computed, then all states are merged.
+    Malformed line offsets in the report are relative to their partition.
+    '''
+    metrics = [METRICS[m]() if isinstance(m, str) else m for m in metrics]
+    keys = [metric_key(m) for m in metrics]
+    os.makedirs(cache_dir, exist_ok=True)
+    hashes_path = os.path.join(cache_dir, 'hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path, 'r') as f:
+            hashes = json.load(f)
+
+    states, report = [m.zero() for m in metrics], empty_report(metrics)
+    for path in paths:
+        content = partition_hash(path, hashes)
+        entries = [os.path.join(cache_dir, f'{content}-{k}.pkl') for k in keys]
+        missing = [i for i, e in enumerate(entries) if not os.path.exists(e)]
+
+        if missing:
+            print(f"Computing {len(missing)} metrics over {path}")
+            results, run_report = run_metrics(path, [MetricState(metrics[i]) for i in missing], workers, chunk_bytes)
+            for i in missing:
+                name = metrics[i].name
+                entry_report = dict(run_report, metric_errors={name: run_report['metric_errors'][name]})
+                atomic_write(entries[i], pickle.dumps((results[name], entry_report)))
+
+        #Line counts are the same in every entry of a partition, metric errors are per entry
+        part_report = empty_report(metrics)
+        for i, (m, entry) in enumerate(zip(metrics, entries)):
+            with open(entry, 'rb') as f:
+                state, entry_report = pickle.load(f)
+            states[i] = m.merge(states[i], state)
+            part_report.update(lines=entry_report['lines'], malformed=entry_report['malformed'],
+                               malformed_offsets=entry_report['malformed_offsets'])
+            part_report['metric_errors'][m.name] = entry_report['metric_errors'][m.name]
+        report = merge_reports(report, part_report)
+
+    atomic_write(hashes_path, json.dumps(hashes).encode())
+    return {m.name: m.result(s) for m, s in zip(metrics, states)}, report
+
+class MetricState(Accumulator):
+    'Wraps a metric so that run_metrics returns its raw (mergeable) state instead of its result'
+    def __init__(self, metric):
+        self.metric = metric
+        self.name = metric.name
+
+    def zero(self):
+        return self.metric.zero()
+
+    def add(self, state, post):
+        self.metric.add(state, post)
+
+    def merge(self, a, b):
+        return self.metric.merge(a, b)
+
+def analyze_sentiment(file_path, min_count=100, workers=1, cache_dir=None):
+    'file_path may also be a list of partition files. With a cache_dir, unchanged partitions are not read again'
+    paths = [file_path] if isinstance(file_path, str) else file_path
+    if cache_dir is not None:
+        results, report = run_metrics_cached(paths, [TagSentiment()], cache_dir, workers)
+    else:
+        results, report = {'tag_sentiment': {}}, empty_report([TagSentiment()])
+        for path in paths:
+            part, part_report = run_metrics(path, [TagSentiment()], workers)
+            results['tag_sentiment'] = merge_counters(results['tag_sentiment'], part['tag_sentiment'])
+            report = merge_reports(report, part_report)
+    print_report(report)
+    tag_dict = {tag: {'count': c, 'minimum_sentiment': m, 'average_sentiment': a}
+                for tag, (c, m, a) in results['tag_sentiment'].items()}
+
     tag_df = pd.DataFrame.from_dict(tag_dict, orient='index')
     tag_df['average_minimum_sentiment'] = tag_df['minimum_sentiment'] / tag_df['count']
     tag_df['average_average_sentiment'] = tag_df['average_sentiment'] / tag_df['count']
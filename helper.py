@@ -1,6 +1,10 @@
 import json
+import numpy as np
 from datetime import datetime
 from enum import Enum
+import post_store as ps
+from post_store import PostStore
+from scripts.jsonl_io import open_jsonl, loads, strip_compression
 
 class Sentiment(Enum):
     NEGATIVE = 0
@@ -10,9 +14,9 @@ class Sentiment(Enum):
 def load_post_data(path: str, keep_text: bool = False):
     'Loads user data from a .jsonl file, optionally keeping text, if RAM allows'
     data = {}
-    with open(path, 'r') as inp:
+    with open_jsonl(path, 'rb') as inp:
         for line in inp:
-            obj = json.loads(line)
+            obj = loads(line)
 
             #Add text length
             obj['body_len'] = len(obj['body'])
@@ -64,9 +68,15 @@ def load_post_data(path: str, keep_text: bool = False):
     return data
 
 def load_user_data(path: str):
-    'Loads user data from a user .json file'
-    with open(path, 'r') as inp:
-        user_data = json.load(inp)
+    'Loads user data from a user .json file, or from the .jsonl file written by `get_users.py --chunked`'
+    with open_jsonl(path, 'r') as inp:
+        if strip_compression(path).endswith('.jsonl'):
+            user_data = {}
+            for line in inp:
+                u = loads(line)
+                user_data[str(u['id'])] = u
+        else:
+            user_data = json.load(inp)
     
     #Convert dates
     for _, u in user_data.items():
@@ -222,4 +232,141 @@ def get_posts_by_tag_and_sentiment(post_data: dict, tag: str, sentiment: int, am
         if post_sentiment_val is not None and post_sentiment_val == sentiment and tag in post_tags:
             result_posts.append(post)
             
-    return result_posts
\ No newline at end of file
+    return result_posts
+
+#Vectorized aggregations over a PostStore. Each is a bulk group-by over the flat item arrays,
+#instead of a Python walk over the nested post dicts. Item kinds are ps.QUESTION/ANSWER/COMMENT
+
+def group_stats(keys, values):
+    '''
+    Groups `values` by `keys`. Returns (unique keys, counts, sums, minima), with keys sorted ascending.
+    '''
+    keys, values = np.asarray(keys), np.asarray(values)
+    if len(keys) == 0:
+        return keys, np.zeros(0, np.int64), np.zeros(0, np.int64), values[:0]
+
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    sums = np.add.reduceat(values.astype(np.int64), starts)
+    minima = np.minimum.reduceat(values, starts)
+    return keys[starts], counts, sums, minima
+
+def get_users_sentiment_stats(store: PostStore, minimum_posts: int = 1):
+    '''
+    Per-user sentiment over everything they posted (questions, answers and comments).
+    Returns a dict of arrays: user, count, mean and min, for users with at least `minimum_posts` items.
+    '''
+    user, sentiment = np.asarray(store.user), np.asarray(store.sentiment)
+    valid = (user != ps.NO_USER) & (sentiment >= 0)
+    users, counts, sums, minima = group_stats(user[valid], sentiment[valid])
+
+    keep = counts >= minimum_posts
+    return {'user': users[keep], 'count': counts[keep], 'mean': sums[keep] / counts[keep], 'min': minima[keep]}
+
+def get_users_average_sentiment_fast(store: PostStore, minimum_posts: int = 10):
+    '''Same result as get_users_average_sentiment, from a PostStore (deleted users are left out)'''
+    stats = get_users_sentiment_stats(store, minimum_posts)
+    return dict(zip(stats['user'].tolist(), stats['mean'].tolist()))
+
+def get_threads_sentiment_stats(store: PostStore, include_answers: bool = True):
+    '''
+    Per-question (thread) sentiment, one entry per question in store order. Returns a dict of arrays:
+    id, count, mean (as get_post_average_sentiment) and min (as min_sentiment). Without answers,
+    only the question and its own comments are considered.
+    '''
+    sentiment = np.asarray(store.sentiment)
+    valid = sentiment >= 0
+    if not include_answers:
+        valid &= (np.asarray(store.kind) == ps.QUESTION) | store.is_comment_on(ps.QUESTION)
+
+    starts = store.question_rows()
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    sums = np.add.reduceat(np.where(valid, sentiment, 0).astype(np.int64), starts)
+    minima = np.minimum.reduceat(np.where(valid, sentiment, np.iinfo(np.int8).max), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+
+    return {'id': np.asarray(store.id)[starts], 'count': counts, 'mean': means, 'min': minima}
+
+def get_tags_sentiment_stats(store: PostStore, min_count: int = 1):
+    '''
+    Per-tag statistics of the questions' threads, like analyze.analyze_sentiment: number of questions,
+    average thread mean, average thread minimum and lowest thread minimum. Returns a dict of arrays.
+    '''
+    threads = get_threads_sentiment_stats(store)
+    thread_of_tag = np.repeat(np.arange(store.n_questions), np.diff(np.asarray(store.tag_offsets)))
+    tag_ids = np.asarray(store.tag_ids)
+    #Threads without any sentiment are skipped, as in analyze
+    has_sentiment = threads['count'][thread_of_tag] > 0
+    thread_of_tag, tag_ids = thread_of_tag[has_sentiment], tag_ids[has_sentiment]
+
+    tags, counts, _, minima = group_stats(tag_ids, threads['min'][thread_of_tag])
+    mean_sums = np.bincount(tag_ids, weights=threads['mean'][thread_of_tag], minlength=len(store.tag_names))[tags]
+    min_sums = np.bincount(tag_ids, weights=threads['min'][thread_of_tag], minlength=len(store.tag_names))[tags]
+
+    keep = counts >= min_count
+    return {'tag': np.array(store.tag_names, dtype=object)[tags[keep]], 'count': counts[keep],
+            'average_sentiment': mean_sums[keep] / counts[keep],
+            'average_minimum_sentiment': min_sums[keep] / counts[keep], 'min': minima[keep]}
+
+def get_sentiment_counts(store: PostStore):
+    '''Number of negative/neutral/positive questions, answers, comments on questions and comments on answers'''
+    kind, sentiment = np.asarray(store.kind), np.asarray(store.sentiment)
+    masks = {'questions': kind == ps.QUESTION, 'answers': kind == ps.ANSWER,
+             'question_comments': store.is_comment_on(ps.QUESTION), 'answer_comments': store.is_comment_on(ps.ANSWER)}
+    return {name: np.bincount(sentiment[m & (sentiment >= 0)], minlength=3) for name, m in masks.items()}
+
+def get_transition_matrix(store: PostStore, child_kind: int = ps.COMMENT, parent_kind: int = None, normalize: bool = True):
+    '''
+    3x3 sentiment flow matrix: entry [i, j] counts items of `child_kind` with sentiment j whose parent has
+    sentiment i, optionally only for parents of `parent_kind`. Rows are normalized to sum 1 by default.
+    '''
+    kind, parent, sentiment = np.asarray(store.kind), np.asarray(store.parent), np.asarray(store.sentiment)
+    children = np.flatnonzero((kind == child_kind) & (parent >= 0))
+    parents = parent[children]
+    if parent_kind is not None:
+        keep = kind[parents] == parent_kind
+        children, parents = children[keep], parents[keep]
+
+    child_s, parent_s = sentiment[children], sentiment[parents]
+    valid = (child_s >= 0) & (parent_s >= 0)
+    matrix = np.bincount(3 * parent_s[valid].astype(np.int64) + child_s[valid], minlength=9).reshape(3, 3).astype(float)
+    if normalize:
+        with np.errstate(invalid='ignore'):
+            matrix /= matrix.sum(axis=1, keepdims=True)
+    return matrix
+
+def get_comment_counts(store: PostStore):
+    '''Number of comments of every item (0 for comments themselves)'''
+    comments = np.asarray(store.kind) == ps.COMMENT
+    return np.bincount(np.asarray(store.parent)[comments], minlength=len(store))
+
+def get_scores_by_sentiment(store: PostStore):
+    '''
+    Scores and comment counts of questions and answers, split by their sentiment (like rq2's collect_post_data).
+    Returns {'scores': [neg, neu, pos], 'num_comments': [neg, neu, pos]}, each a NumPy array.
+    '''
+    kind, sentiment = np.asarray(store.kind), np.asarray(store.sentiment)
+    num_comments = get_comment_counts(store)
+    posts = kind != ps.COMMENT
+    parsed = {'scores': [], 'num_comments': []}
+    for sent in range(3):
+        mask = posts & (sentiment == sent)
+        parsed['scores'].append(np.asarray(store.score)[mask])
+        parsed['num_comments'].append(num_comments[mask])
+    return parsed
+
+def get_user_interactions(store: PostStore):
+    '''
+    Same information as get_user_to_interaction_posts_dict, as flat arrays: (users, offsets, post_ids, dates).
+    The interactions of users[k] are post_ids/dates[offsets[k]:offsets[k + 1]], most recent first.
+    '''
+    user, date = np.asarray(store.user), np.asarray(store.date)
+    valid = np.flatnonzero(user != ps.NO_USER)
+    order = valid[np.lexsort((-date[valid], user[valid]))]
+
+    post_ids = np.asarray(store.id)[store.question_rows()][np.asarray(store.question)[order]]
+    users, starts = np.unique(user[order], return_index=True)
+    return users, np.r_[starts, len(order)], post_ids, date[order].astype('datetime64[us]')
@@ -0,0 +1,118 @@
+import json
+import mmap
+import os
+import random
+import numpy as np
+from array import array
+
+#simdjson parses lazily, so projected reads never decode the skipped values. Plain json is the fallback
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+class JsonlReader:
+    '''
+    Random access to a .jsonl file (one object with an `id` per line) without parsing all of it.
+    The byte offset and id of every line are indexed once and cached next to the file (path + '.lines'),
+    the file itself is memory-mapped. Reads can be projected to a few top-level fields, e.g.
+    fields=['id', 'tags', 'body_sentiment'] never decodes `body`, `title` or the answers.
+    Projection needs the optional pysimdjson package: without it every read falls back to a full json.loads
+    of the line, skipped fields included.
+    '''
+    def __init__(self, path: str, index_path: str = None):
+        self.path = path
+        self.index_path = index_path or path + '.lines'
+        self.parser = simdjson.Parser() if simdjson is not None else None
+
+        marker = os.path.join(self.index_path, 'ids.npy') #Written last
+        if not os.path.exists(marker) or os.path.getmtime(marker) < os.path.getmtime(path):
+            self.build_index()
+        self.offsets = np.load(os.path.join(self.index_path, 'offsets.npy'), mmap_mode='r')
+        self.ids = np.load(marker, mmap_mode='r')
+        self.id_order = None
+
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if len(self) else b''
+
+    def build_index(self):
+        offsets, ids = array('q', [0]), array('q')
+        with open(self.path, 'rb') as inp:
+            for line in inp:
+                offsets.append(offsets[-1] + len(line))
+                ids.append(self.parse(line, ['id'])['id'])
+
+        os.makedirs(self.index_path, exist_ok=True)
+        np.save(os.path.join(self.index_path, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+        np.save(os.path.join(self.index_path, 'ids.npy'), np.frombuffer(ids, dtype=np.int64))
+
+    def parse(self, line: bytes, fields: list = None):
+        'Parses a line, keeping only `fields` (all of them when None)'
+        if fields is None:
+            return json.loads(line)
+        if self.parser is None:
+            obj = json.loads(line)
+            return {k: obj[k] for k in fields if k in obj}
+
+        doc = self.parser.parse(line)
+        obj = {}
+        for k in fields:
+            if k in doc:
+                value = doc[k]
+                #Lazy proxies are only valid until the next parse, materialize them
+                if isinstance(value, simdjson.Object):
+                    value = value.as_dict()
+                elif isinstance(value, simdjson.Array):
+                    value = value.as_list()
+                obj[k] = value
+        return obj
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, n: int):
+        'Raw bytes of line n'
+        return self.data[self.offsets[n]:self.offsets[n + 1]]
+
+    def get(self, n: int, fields: list = None):
+        return self.parse(self.line(n), fields)
+
+    def __getitem__(self, n: int):
+        return self.get(n)
+
+    def find_line(self, id: int):
+        'Line number of the (first) object with the given id, None if there is none'
+        if self.id_order is None:
+            self.id_order = np.argsort(self.ids, kind='stable')
+        k = np.searchsorted(self.ids, id, sorter=self.id_order)
+        if k == len(self.id_order) or self.ids[self.id_order[k]] != id:
+            return None
+        return int(self.id_order[k])
+
+    def by_id(self, id: int, fields: list = None):
+        n = self.find_line(id)
+        return None if n is None else self.get(n, fields)
+
+    def sample(self, amount: int, fields: list = None, seed: int = None):
+        'Random sample of `amount` objects, read in file order'
+        lines = random.Random(seed).sample(range(len(self)), min(amount, len(self)))
+        return [self.get(n, fields) for n in sorted(lines)]
+
+    def iter(self, fields: list = None, start: int = 0, end: int = None):
+        'Iterates over lines [start, end), optionally projected'
+        for n in range(start, len(self) if end is None else end):
+            yield self.get(n, fields)
+
+    def __iter__(self):
+        return self.iter()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
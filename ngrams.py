@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import numpy as np
+from scripts.lemma_store import load_lemmas
+
+#Counts are kept per sentiment class, plus the total over every document in column 0
+CLASSES = 3
+MIX = np.uint64(0x100000001B3)
+
+class Vocabulary:
+    'Stable 64-bit hashes of tokens, remembering every token seen so that ids can be turned back into text'
+    def __init__(self):
+        self.ids = {}
+        self.tokens = {}
+
+    def id(self, token: str):
+        h = self.ids.get(token)
+        if h is None:
+            h = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), 'little')
+            self.ids[token] = h
+            self.tokens[h] = token
+        return h
+
+    def encode(self, tokens: list):
+        return np.array([self.id(t) for t in tokens], dtype=np.uint64)
+
+    def decode(self, ids):
+        return [self.tokens.get(int(h), '?') for h in ids]
+
+class CountMinSketch:
+    'Approximate total counts in a fixed depth x width table. Estimates never undercount'
+    def __init__(self, width: int = 1 << 20, depth: int = 4):
+        self.width, self.depth = width, depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.seeds = np.array([0x9E3779B97F4A7C15 * (i + 1) % (1 << 64) for i in range(depth)], dtype=np.uint64)
+
+    def columns(self, keys, row):
+        return ((keys ^ self.seeds[row]) * MIX % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, keys, counts):
+        for row in range(self.depth):
+            np.add.at(self.table[row], self.columns(keys, row), counts)
+
+    def query(self, keys):
+        return np.min([self.table[row][self.columns(keys, row)] for row in range(self.depth)], axis=0)
+
+class NgramCounter:
+    '''
+    Counts n-grams per sentiment class over a stream of tokenized documents. N-grams are keyed by a 64-bit
+    mix of their token hashes (no string keys), and counts live in sorted NumPy arrays merged in bulk every
+    `flush_tokens` tokens. With max_entries, the rarest n-grams are pruned whenever the table grows past it;
+    their counts go to an optional CountMinSketch, so totals of the kept n-grams stay upper bounds.
+    '''
+    def __init__(self, n: int, vocab: Vocabulary, max_entries: int = None, sketch: CountMinSketch = None,
+                 flush_tokens: int = 1 << 22):
+        self.n = n
+        self.vocab = vocab
+        self.max_entries = max_entries
+        self.sketch = sketch
+        self.flush_tokens = flush_tokens
+
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.parts = np.zeros((0, n), dtype=np.uint64)  #Token hashes of each n-gram, to decode it
+        self.counts = np.zeros((0, CLASSES + 1), dtype=np.int64)
+        self.buffer, self.buffer_classes, self.buffered = [], [], 0
+
+    def add(self, ids, sentiment):
+        'Adds a document, as token hashes (Vocabulary.encode). sentiment may be None'
+        if len(ids) < self.n:
+            return
+        self.buffer.append(ids)
+        self.buffer_classes.append(-1 if sentiment is None else sentiment)
+        self.buffered += len(ids)
+        if self.buffered >= self.flush_tokens:
+            self.flush()
+
+    def ngrams(self, ids):
+        'Keys and parts of every n-gram of a document'
+        count = len(ids) - self.n + 1
+        parts = np.stack([ids[i:i + count] for i in range(self.n)], axis=1)
+        keys = parts[:, 0].copy()
+        for i in range(1, self.n):
+            keys = keys * MIX ^ parts[:, i]
+        return keys, parts
+
+    def flush(self):
+        if not self.buffer:
+            return
+        grams = [self.ngrams(ids) for ids in self.buffer]
+        keys = np.concatenate([k for k, _ in grams])
+        parts = np.concatenate([p for _, p in grams])
+        classes = np.repeat(np.array(self.buffer_classes), [len(k) for k, _ in grams])
+        self.buffer, self.buffer_classes, self.buffered = [], [], 0
+
+        counts = np.zeros((len(keys), CLASSES + 1), dtype=np.int64)
+        counts[:, 0] = 1
+        has_class = classes >= 0
+        counts[np.flatnonzero(has_class), classes[has_class] + 1] = 1
+        self.merge(keys, parts, counts)
+
+    def merge(self, keys, parts, counts):
+        'Adds (unsorted, possibly repeated) entries to the table'
+        keys = np.concatenate([self.keys, keys])
+        parts = np.concatenate([self.parts, parts])
+        counts = np.concatenate([self.counts, counts])
+
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, np.int64)
+        self.keys = keys[starts]
+        self.parts = parts[order[starts]]
+        self.counts = np.add.reduceat(counts[order], starts, axis=0) if len(keys) else counts
+        self.prune()
+
+    def prune(self):
+        if self.max_entries is None or len(self.keys) <= self.max_entries:
+            return
+        #Keep the max_entries most frequent n-grams
+        keep = np.zeros(len(self.keys), dtype=bool)
+        keep[np.argpartition(-self.counts[:, 0], self.max_entries - 1)[:self.max_entries]] = True
+        if self.sketch is not None:
+            self.sketch.add(self.keys[~keep], self.counts[~keep, 0])
+        self.keys, self.parts, self.counts = self.keys[keep], self.parts[keep], self.counts[keep]
+
+    def totals(self):
+        'Total count of every kept n-gram, plus the sketch estimate of what was pruned before it was seen again'
+        self.flush()
+        if self.sketch is None:
+            return self.counts[:, 0]
+        return self.counts[:, 0] + self.sketch.query(self.keys)
+
+    def decode(self, rows):
+        return [' '.join(self.vocab.decode(self.parts[r])) for r in rows]
+
+def tfidf_ranking(counter: NgramCounter, sentiment: int, n_docs: int, top: int = 100, stop_words: set = ()):
+    '''
+    [(tf-idf, n-gram)] of a sentiment class, best first, like word_cloud.ipynb: the class count times
+    log(n_docs / total count). N-grams made only of stop words are left out.
+    '''
+    totals = counter.totals()
+    scores = counter.counts[:, sentiment + 1] * np.log(n_docs / np.maximum(totals, 1))
+    if stop_words:
+        stop = np.isin(counter.parts, np.array([counter.vocab.id(w) for w in stop_words], dtype=np.uint64))
+        scores = np.where(stop.all(axis=1), -np.inf, scores)
+
+    rows = np.argsort(-scores, kind='stable')
+    rows = rows[(counter.counts[rows, sentiment + 1] > 0) & np.isfinite(scores[rows])][:top]
+    return list(zip(scores[rows].tolist(), counter.decode(rows)))
+
+def lemmatized_docs(path: str, vocab: Vocabulary):
+    '''
+    Yields (token hashes, sentiment) of every document of a lemmatized .jsonl file (lines with `sentiment`
+    and `lemmatized`) or of a lemmatizer.py output directory
+    '''
+    if os.path.isdir(path):
+        docs, tokens, lemmas = load_lemmas(path)
+        hashes = vocab.encode(lemmas) #Lemma id -> token hash
+        for start, length, sentiment in zip(docs['start'].tolist(), docs['length'].tolist(), docs['sentiment'].tolist()):
+            yield hashes[tokens[start:start + length]], None if sentiment < 0 else sentiment
+    else:
+        with open(path, 'r') as inp:
+            for line in inp:
+                obj = json.loads(line)
+                yield vocab.encode(obj['lemmatized']), obj['sentiment']
+
+def count_ngrams(path: str, sizes=(1, 2), max_entries: int = None, sketch_width: int = None):
+    '''
+    Counts every n-gram size of `sizes` per sentiment in one pass over lemmatized documents (see lemmatized_docs).
+    Returns ({n: NgramCounter}, number of documents).
+    '''
+    vocab = Vocabulary()
+    counters = {n: NgramCounter(n, vocab, max_entries, CountMinSketch(sketch_width) if sketch_width else None) for n in sizes}
+    n_docs = 0
+    for ids, sentiment in lemmatized_docs(path, vocab):
+        for counter in counters.values():
+            counter.add(ids, sentiment)
+        n_docs += 1
+
+    for counter in counters.values():
+        counter.flush()
+    return counters, n_docs
@@ -0,0 +1,143 @@
+import json
+import os
+import random
+import numpy as np
+from array import array
+from datetime import datetime
+from post_store import open_derived
+from scripts.jsonl_io import loads
+
+#Indexed fields: question tags, owner/commenter user ids anywhere in the thread, question sentiment and creation year
+FIELDS = ['tag', 'user', 'sentiment', 'year']
+
+class PostIndex:
+    '''
+    Inverted index of an analyzed .jsonl file: for every tag, user id, sentiment and year, the sorted line
+    numbers of the posts (threads) that match it, plus the byte offset of every line. Queries intersect
+    the posting lists and the matching posts are read back by seeking to their lines.
+    '''
+    def __init__(self, path: str, line_offsets, postings: dict, tag_names: list):
+        self.path = path
+        self.line_offsets = line_offsets
+        self.postings = postings #field -> (keys, offsets, lines)
+        self.tag_names = tag_names
+        self.tag_index = {t: i for i, t in enumerate(tag_names)}
+
+    def __len__(self):
+        return len(self.line_offsets)
+
+    def keys(self, field: str):
+        'Every value of `field` present in the index'
+        keys = self.postings[field][0]
+        return [self.tag_names[k] for k in keys] if field == 'tag' else np.asarray(keys).tolist()
+
+    def posting(self, field: str, value):
+        'Sorted line numbers of the posts with `field` == value'
+        keys, offsets, lines = self.postings[field]
+        if field == 'tag':
+            if value not in self.tag_index:
+                return np.zeros(0, np.int64)
+            value = self.tag_index[value]
+        k = np.searchsorted(keys, value)
+        if k == len(keys) or keys[k] != value:
+            return np.zeros(0, np.int64)
+        return np.asarray(lines[offsets[k]:offsets[k + 1]])
+
+    def lines(self, tag: str = None, user: int = None, sentiment: int = None, year: int = None):
+        'Sorted line numbers of the posts matching every given condition (all posts if none is given)'
+        result = None
+        for field, value in zip(FIELDS, [tag, user, sentiment, year]):
+            if value is None:
+                continue
+            found = self.posting(field, value)
+            result = found if result is None else np.intersect1d(result, found, assume_unique=True)
+        return np.arange(len(self)) if result is None else result
+
+    def read(self, lines):
+        'Reads and parses the given lines of the .jsonl file, in the given order'
+        posts = []
+        with open(self.path, 'rb') as inp:
+            for line in lines:
+                inp.seek(int(self.line_offsets[line]))
+                posts.append(loads(inp.readline()))
+        return posts
+
+    def find(self, amount: int = None, **conditions):
+        'First `amount` posts (in file order) matching the conditions, see `lines`'
+        return self.read(self.lines(**conditions)[:amount])
+
+    def sample(self, amount: int, seed: int = None, **conditions):
+        'Random sample of `amount` posts matching the conditions'
+        lines = self.lines(**conditions).tolist()
+        chosen = random.Random(seed).sample(lines, min(amount, len(lines)))
+        return self.read(sorted(chosen))
+
+    @classmethod
+    def build(cls, path: str):
+        'Builds the index from an analyzed .jsonl file, in a single pass'
+        line_offsets = array('q')
+        entries = {field: (array('q'), array('q')) for field in FIELDS}
+        tag_index = {}
+
+        def add(field, key, line):
+            entries[field][0].append(key)
+            entries[field][1].append(line)
+
+        with open(path, 'rb') as inp:
+            pos = 0
+            for line_no, line in enumerate(inp):
+                line_offsets.append(pos)
+                pos += len(line)
+                obj = loads(line)
+
+                for t in obj['tags']:
+                    add('tag', tag_index.setdefault(t, len(tag_index)), line_no)
+                if obj.get('body_sentiment') is not None:
+                    add('sentiment', obj['body_sentiment'], line_no)
+                add('year', datetime.fromisoformat(obj['creation_date']).year, line_no)
+
+                users = {c['user_id'] for c in obj['comments']}
+                users.add(obj.get('owner_user_id'))
+                for a in obj['answers']:
+                    users.add(a.get('owner_user_id'))
+                    users.update(c['user_id'] for c in a['comments'])
+                for u in users - {None}:
+                    add('user', int(u), line_no)
+
+        postings = {}
+        for field, (keys, lines) in entries.items():
+            keys, lines = np.frombuffer(keys, dtype=np.int64), np.frombuffer(lines, dtype=np.int64)
+            order = np.lexsort((lines, keys))
+            keys, lines = keys[order], lines[order]
+            unique, starts = np.unique(keys, return_index=True)
+            postings[field] = (unique, np.r_[starts, len(keys)].astype(np.int64), lines)
+
+        return cls(path, np.frombuffer(line_offsets, dtype=np.int64).copy(), postings, list(tag_index))
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'line_offsets.npy'), np.asarray(self.line_offsets))
+        for field, arrays in self.postings.items():
+            for name, arr in zip(['keys', 'offsets', 'lines'], arrays):
+                np.save(os.path.join(path, f'{field}_{name}.npy'), np.asarray(arr))
+        with open(os.path.join(path, 'tags.json'), 'w') as outp:
+            json.dump(self.tag_names, outp)
+
+    @classmethod
+    def load(cls, path: str, data_path: str, mmap: bool = True):
+        'Loads a saved index of `data_path`, memory-mapping the arrays unless mmap is False'
+        mode = 'r' if mmap else None
+        line_offsets = np.load(os.path.join(path, 'line_offsets.npy'), mmap_mode=mode)
+        postings = {field: tuple(np.load(os.path.join(path, f'{field}_{name}.npy'), mmap_mode=mode)
+                                 for name in ['keys', 'offsets', 'lines'])
+                    for field in FIELDS}
+        with open(os.path.join(path, 'tags.json'), 'r') as inp:
+            tag_names = json.load(inp)
+        return cls(data_path, line_offsets, postings, tag_names)
+
+def open_post_index(path: str, index_path: str = None):
+    '''
+    Returns the PostIndex of an analyzed .jsonl file, memory-mapped from `index_path` (default: path + '.index').
+    The index is (re)built first if it is missing or older than the .jsonl file.
+    '''
+    return open_derived(PostIndex, path, index_path or path + '.index', path)
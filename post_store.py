@@ -0,0 +1,150 @@
+import json
+import os
+import numpy as np
+from array import array
+from datetime import datetime, timezone
+from scripts.jsonl_io import open_jsonl, loads
+
+#Item kinds. Comments are told apart by the kind of their parent
+QUESTION, ANSWER, COMMENT = 0, 1, 2
+NO_USER = np.iinfo(np.int64).min
+NO_SENTIMENT = -1
+
+#One row per question, answer and comment, in thread order: question, its comments, then each answer and its comments
+ITEM_COLUMNS = {
+    'kind': 'i1',
+    'id': 'i8',
+    'parent': 'i8',     #Row of the parent item, -1 for questions
+    'question': 'i4',   #Index of the thread (question) the item belongs to
+    'user': 'i8',       #Owner/commenter id, NO_USER if deleted
+    'date': 'i8',       #creation_date, as UTC epoch microseconds
+    'sentiment': 'i1',  #body_sentiment/text_sentiment, NO_SENTIMENT if missing
+    'score': 'i4',
+    'length': 'i4',     #Length of the body/comment text
+}
+#thread_offsets[q] is the row of question q, its items end at thread_offsets[q + 1]. Tags are ragged the same way
+THREAD_COLUMNS = {'thread_offsets': 'i8', 'tag_ids': 'i4', 'tag_offsets': 'i8'}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def to_epoch_us(iso: str):
+    'ISO date -> UTC epoch microseconds, naive dates are taken as UTC'
+    dt = datetime.fromisoformat(iso)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+class PostStore:
+    '''
+    Columnar representation of an analyzed .jsonl file: flat NumPy arrays for every question, answer
+    and comment, with parent offsets, int64 epoch dates and int8 sentiment. Built once with `build`,
+    saved as a directory of .npy files and memory-mapped back with `load`.
+    '''
+    def __init__(self, columns: dict, tag_names: list):
+        for name in list(ITEM_COLUMNS) + list(THREAD_COLUMNS):
+            setattr(self, name, columns[name])
+        self.tag_names = tag_names
+
+    def __len__(self):
+        return len(self.kind)
+
+    @property
+    def n_questions(self):
+        return len(self.thread_offsets) - 1
+
+    def question_rows(self):
+        return np.asarray(self.thread_offsets[:-1])
+
+    def tags_of(self, q: int):
+        return [self.tag_names[t] for t in self.tag_ids[self.tag_offsets[q]:self.tag_offsets[q + 1]]]
+
+    def dates(self):
+        'creation_date of every item as datetime64[us] (UTC)'
+        return np.asarray(self.date).astype('datetime64[us]')
+
+    def is_comment_on(self, parent_kind: int):
+        'Mask of the comments whose parent is a question (QUESTION) or an answer (ANSWER)'
+        parent_kind_of = np.asarray(self.kind)[np.maximum(np.asarray(self.parent), 0)]
+        return (np.asarray(self.kind) == COMMENT) & (parent_kind_of == parent_kind)
+
+    @classmethod
+    def build(cls, path: str):
+        'Builds the store from an analyzed .jsonl file, in a single pass'
+        cols = {name: array('q') for name in ITEM_COLUMNS}
+        thread_offsets, tag_ids, tag_offsets = array('q', [0]), array('q'), array('q', [0])
+        tag_index = {}
+
+        def add(obj, kind, parent, question, user_key, sentiment_key, text_key):
+            row = len(cols['kind'])
+            user = obj.get(user_key)
+            sentiment = obj.get(sentiment_key)
+            cols['kind'].append(kind)
+            cols['id'].append(obj['id'])
+            cols['parent'].append(parent)
+            cols['question'].append(question)
+            cols['user'].append(NO_USER if user is None else int(user))
+            cols['date'].append(to_epoch_us(obj['creation_date']))
+            cols['sentiment'].append(NO_SENTIMENT if sentiment is None else sentiment)
+            cols['score'].append(obj.get('score') or 0)
+            cols['length'].append(len(obj.get(text_key) or ''))
+            return row
+
+        def add_comments(post, parent, question):
+            for c in post['comments']:
+                add(c, COMMENT, parent, question, 'user_id', 'text_sentiment', 'text')
+
+        with open_jsonl(path, 'rb') as inp:
+            for line in inp:
+                obj = loads(line)
+                q = len(thread_offsets) - 1
+
+                row = add(obj, QUESTION, -1, q, 'owner_user_id', 'body_sentiment', 'body')
+                add_comments(obj, row, q)
+                for a in obj['answers']:
+                    a_row = add(a, ANSWER, row, q, 'owner_user_id', 'body_sentiment', 'body')
+                    add_comments(a, a_row, q)
+
+                for t in obj['tags']:
+                    tag_ids.append(tag_index.setdefault(t, len(tag_index)))
+                tag_offsets.append(len(tag_ids))
+                thread_offsets.append(len(cols['kind']))
+
+        columns = {name: np.frombuffer(cols[name], dtype=np.int64).astype(dtype) for name, dtype in ITEM_COLUMNS.items()}
+        columns['thread_offsets'] = np.frombuffer(thread_offsets, dtype=np.int64).copy()
+        columns['tag_ids'] = np.frombuffer(tag_ids, dtype=np.int64).astype(np.int32)
+        columns['tag_offsets'] = np.frombuffer(tag_offsets, dtype=np.int64).copy()
+        return cls(columns, list(tag_index))
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in list(ITEM_COLUMNS) + list(THREAD_COLUMNS):
+            np.save(os.path.join(path, f'{name}.npy'), np.asarray(getattr(self, name)))
+        with open(os.path.join(path, 'tags.json'), 'w') as outp:
+            json.dump(self.tag_names, outp)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        'Loads a saved store, memory-mapping the arrays unless mmap is False'
+        columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+                   for name in list(ITEM_COLUMNS) + list(THREAD_COLUMNS)}
+        with open(os.path.join(path, 'tags.json'), 'r') as inp:
+            tag_names = json.load(inp)
+        return cls(columns, tag_names)
+
+def open_derived(cls, path: str, derived_path: str, *load_args):
+    '''
+    Loads a structure derived from a .jsonl file (a class with build(path), save(dir) and load(dir, ...)) from
+    `derived_path`, (re)building and saving it first if it is missing or older than the .jsonl file.
+    '''
+    marker = os.path.join(derived_path, 'tags.json') #Written last by save
+    if not os.path.exists(marker) or os.path.getmtime(marker) < os.path.getmtime(path):
+        cls.build(path).save(derived_path)
+    return cls.load(derived_path, *load_args)
+
+def open_post_store(path: str, store_path: str = None):
+    '''
+    Returns the PostStore of an analyzed .jsonl file, memory-mapped from `store_path` (default: path + '.store').
+    The store is (re)built first if it is missing or older than the .jsonl file.
+    '''
+    return open_derived(PostStore, path, store_path or path + '.store')
@@ -0,0 +1,172 @@
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+import argparse
+import hashlib
+import json
+import numpy as np
+import os
+import time
+import torch
+import transformers
+
+BACKENDS = ['eager', 'torchscript', 'onnx']
+
+class LogitsOnly(torch.nn.Module):
+    '''Wraps a HF model so that tracing sees plain tensors in and out'''
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+class TorchScriptModel:
+    '''Traced model, called like a HF model: model(input_ids=..., attention_mask=...)[0] are the logits'''
+    def __init__(self, traced):
+        self.traced = traced
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        return (self.traced(input_ids, attention_mask),)
+
+class OnnxModel:
+    '''ONNX Runtime session, called like a HF model: model(input_ids=..., attention_mask=...)[0] are the logits'''
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, opts, providers=['CPUExecutionProvider'])
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        logits = self.session.run(['logits'], {'input_ids': input_ids.cpu().numpy(),
+                                               'attention_mask': attention_mask.cpu().numpy()})[0]
+        return (torch.from_numpy(logits),)
+
+def export_fingerprint(name, tokenizer, backend):
+    '''
+    Short hash of everything an exported graph depends on: the model config, its weights (the size and mtime
+    of local files, the commit of hub models), the tokenizer's max length and the exporting library versions
+    '''
+    config = AutoConfig.from_pretrained(name)
+    parts = [config.to_json_string(), str(getattr(config, '_commit_hash', None)), str(tokenizer.model_max_length),
+             torch.__version__, transformers.__version__]
+    if os.path.isdir(name):
+        for f in sorted(os.listdir(name)):
+            stat = os.stat(os.path.join(name, f))
+            parts.append(f'{f}:{stat.st_size}:{stat.st_mtime_ns}')
+    if backend == 'onnx':
+        import onnxruntime
+        parts.append(onnxruntime.__version__)
+    return hashlib.blake2b('\0'.join(parts).encode(), digest_size=6).hexdigest()
+
+def export_path(export_dir, name, fingerprint, suffix):
+    'Exports of another model version get another path, so they are re-exported instead of reused'
+    return os.path.join(export_dir, f"{name.strip('/').replace('/', '--')}.{fingerprint}{suffix}")
+
+def example_inputs(tokenizer):
+    enc = tokenizer(['example input', 'a slightly longer example input text'], padding=True, return_tensors='pt')
+    return enc['input_ids'], enc['attention_mask']
+
+def quantize(model):
+    'Dynamic int8 quantization of the linear layers'
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_backend(name, backend='eager', int8=False, export_dir='./exported', threads=None, device=torch.device('cpu')):
+    '''
+    Loads (tokenizer, model, device) for the given backend, where device is where the model's inputs must go:
+    quantized and exported models always run on the CPU. Every model is called the same way as the eager
+    HF model, so classify_sentiment/classify_batch work unchanged. Exported graphs are cached in export_dir.
+    '''
+    cpu = torch.device('cpu')
+    tokenizer = AutoTokenizer.from_pretrained(name)
+
+    if backend == 'eager':
+        model = AutoModelForSequenceClassification.from_pretrained(name)
+        if int8:
+            return tokenizer, quantize(model), cpu
+        return tokenizer, model.to(device), device
+
+    os.makedirs(export_dir, exist_ok=True)
+    fingerprint = export_fingerprint(name, tokenizer, backend)
+
+    if backend == 'torchscript':
+        path = export_path(export_dir, name, fingerprint, '.int8.pt' if int8 else '.pt')
+        if not os.path.exists(path):
+            model = AutoModelForSequenceClassification.from_pretrained(name, attn_implementation='eager')
+            model.eval()
+            if int8:
+                model = quantize(model)
+            with torch.inference_mode():
+                traced = torch.jit.trace(LogitsOnly(model), example_inputs(tokenizer))
+            torch.jit.save(traced, path)
+        return tokenizer, TorchScriptModel(torch.jit.load(path)), cpu
+
+    if backend == 'onnx':
+        path = export_path(export_dir, name, fingerprint, '.onnx')
+        if not os.path.exists(path):
+            model = AutoModelForSequenceClassification.from_pretrained(name, attn_implementation='eager')
+            model.eval()
+            axes = {0: 'batch', 1: 'sequence'}
+            torch.onnx.export(model, example_inputs(tokenizer), path, dynamo=False,
+                              input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                              dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'logits': {0: 'batch'}})
+        if int8:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            qpath = export_path(export_dir, name, fingerprint, '.int8.onnx')
+            if not os.path.exists(qpath):
+                quantize_dynamic(path, qpath, weight_type=QuantType.QInt8)
+            path = qpath
+        return tokenizer, OnnxModel(path, threads), cpu
+
+    raise ValueError(f'Unknown backend {backend}, expected one of {BACKENDS}')
+
+def agreement_check(tokenizer, model, path='./data/full-human-labels.jsonl'):
+    '''
+    Classifies the human-labelled texts one by one, reporting accuracy against the human labels,
+    agreement with the labels of the original full-precision model, and per-text latency.
+    '''
+    from classifier import classify_sentiment
+
+    human, original, predicted, latencies = [], [], [], []
+    with open(path, 'r') as inp:
+        for line in inp:
+            obj = json.loads(line)
+            start = time.perf_counter()
+            with torch.inference_mode():
+                predicted.append(classify_sentiment(tokenizer, model, obj['text']))
+            latencies.append(time.perf_counter() - start)
+            human.append(obj['human_label_sentiment'])
+            original.append(obj['labeled_sentiment'])
+
+    human, original, predicted = np.array(human), np.array(original), np.array(predicted)
+    latencies = np.array(latencies) * 1000
+    return {
+        'texts': len(predicted),
+        'accuracy': float((predicted == human).mean()),
+        'agreement': float((predicted == original).mean()),
+        'latency_ms_mean': float(latencies.mean()),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+    }
+
+if __name__ == '__main__':
+    import classifier
+    from classifier import MODEL
+
+    parser = argparse.ArgumentParser(description='Agreement and latency check of an inference backend')
+    parser.add_argument('--model', type=str, help='Model name or local path', default=MODEL)
+    parser.add_argument('--backend', type=str, choices=BACKENDS, default='eager')
+    parser.add_argument('--int8', action='store_true', help='Use dynamic int8 quantization')
+    parser.add_argument('--export-dir', type=str, default='./exported', help='Where exported graphs are cached')
+    parser.add_argument('--labels', type=str, default='./data/full-human-labels.jsonl', help='Human-labelled JSONL file')
+    args = parser.parse_args()
+
+    #classify_sentiment sends its inputs to classifier.device
+    tokenizer, model, classifier.device = load_backend(args.model, args.backend, args.int8, args.export_dir, device=classifier.device)
+    result = agreement_check(tokenizer, model, args.labels)
+
+    print(f"Backend: {args.backend}{' (int8)' if args.int8 else ''} | {result['texts']} texts")
+    print(f"Accuracy vs human labels: {result['accuracy']:.3f}")
+    print(f"Agreement with original labels: {result['agreement']:.3f}")
+    print(f"Latency: {result['latency_ms_mean']:.1f} ms mean, {result['latency_ms_p95']:.1f} ms p95")
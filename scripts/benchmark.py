@@ -0,0 +1,280 @@
+import os
+import sys
+#Root modules (helper, analyze, post_store) live one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analyze
+import classifier
+import cleaner
+import helper
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import torch
+from datetime import datetime, timedelta, timezone
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast, RobertaConfig, RobertaForSequenceClassification
+
+STAGES = ['clean', 'classify', 'load_dict', 'load_store', 'aggregate_dict', 'aggregate_store', 'metrics']
+WORDS = ['the', 'a', 'is', 'to', 'in', 'it', 'this', 'error', 'code', 'function', 'value', 'null', 'thanks',
+         'why', 'how', 'does', 'not', 'work', 'use', 'you', 'can', 'should', 'return', 'array', 'string',
+         'great', 'wrong', 'please', 'question', 'answer', 'duplicate', 'help', 'bad', 'good', 'try']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Times every pipeline stage over a synthetic dump, offline')
+
+    parser.add_argument('-o', type=str, default='./benchmark-results.jsonl', help='Results file, one JSON line appended per run')
+    parser.add_argument('--posts', type=int, default=2000, help='Questions in the synthetic dump')
+    parser.add_argument('--answers', type=float, default=2, help='Mean answers per question')
+    parser.add_argument('--comments', type=float, default=2, help='Mean comments per question/answer')
+    parser.add_argument('--text-words', type=int, default=80, help='Mean words per body (comments get a quarter)')
+    parser.add_argument('--tags', type=int, default=500, help='Tag cardinality')
+    parser.add_argument('--users', type=int, default=5000, help='User id cardinality')
+    parser.add_argument('--vocab', type=int, default=2000, help='Distinct words in the texts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', type=str, default=','.join(STAGES), help='Comma separated stages to time')
+    parser.add_argument('--max-tokens', type=int, default=8192, help='Token budget per classification batch')
+    parser.add_argument('--workdir', type=str, default=None, help='Where the dump, model and outputs go (default: a temp dir)')
+    parser.add_argument('--compare', action='store_true', help='Compare with the previous run of the same configuration in the results file')
+
+    return parser.parse_args()
+
+def poisson(rng, mean):
+    'Knuth sampling, fine for small means'
+    limit, k, p = 2.718281828459045 ** -mean, 0, 1.0
+    while True:
+        p *= rng.random()
+        if p <= limit:
+            return k
+        k += 1
+
+def make_vocab(size):
+    return WORDS + [f'w{i}' for i in range(max(size - len(WORDS), 0))]
+
+def make_text(rng, vocab, words, html):
+    'Random text, as HTML paragraphs (bodies) or markdown (comments), with some code and links'
+    tokens = rng.choices(vocab, k=max(1, poisson(rng, words)))
+    if not html:
+        if rng.random() < 0.3:
+            tokens.insert(rng.randrange(len(tokens) + 1), f'`{rng.choice(vocab)}()`')
+        if rng.random() < 0.2:
+            tokens.append(f'[{rng.choice(vocab)}](https://example.com/{rng.randrange(1000)})')
+        return ' '.join(tokens)
+
+    paragraphs, i = [], 0
+    while i < len(tokens):
+        n = rng.randint(10, 40)
+        paragraphs.append(f"<p>{' '.join(tokens[i:i + n])}.</p>")
+        i += n
+    if rng.random() < 0.5:
+        paragraphs.insert(1, f"<pre><code>{rng.choice(vocab)} = {rng.choice(vocab)}({rng.randrange(100)});\n</code></pre>")
+    if rng.random() < 0.3:
+        paragraphs.append(f'<p>See <a href="https://example.com/{rng.randrange(1000)}">{rng.choice(vocab)}</a></p>')
+    return '\n'.join(paragraphs)
+
+def make_dump(path, args):
+    '''Writes a raw dump shaped like data/sample.jsonl (converter.py output)'''
+    rng = random.Random(args.seed)
+    vocab = make_vocab(args.vocab)
+    tags = [f'tag{i}' for i in range(args.tags)]
+    next_id = [10000000]
+    date = [datetime(2014, 1, 1, tzinfo=timezone(timedelta(hours=-3)))]
+
+    def new_id():
+        next_id[0] += 1
+        return next_id[0]
+
+    def new_date():
+        date[0] += timedelta(seconds=rng.randint(1, 3600))
+        return date[0].isoformat()
+
+    def user():
+        return None if rng.random() < 0.05 else rng.randrange(1, args.users + 1)
+
+    def comments(post_id):
+        return [{'id': new_id(), 'post_id': post_id, 'user_id': user(), 'score': poisson(rng, 1),
+                 'text': make_text(rng, vocab, args.text_words / 4, False), 'creation_date': new_date()}
+                for _ in range(poisson(rng, args.comments))]
+
+    with open(path, 'w') as outp:
+        for _ in range(args.posts):
+            q = {'id': new_id(), 'owner_user_id': user(), 'score': poisson(rng, 2),
+                 'tags': rng.sample(tags, min(rng.randint(1, 5), len(tags))),
+                 'title': make_text(rng, vocab, 8, False), 'body': make_text(rng, vocab, args.text_words, True)}
+            q['creation_date'] = new_date()
+            q['comments'] = comments(q['id'])
+            q['comment_count'] = len(q['comments'])
+            q['answers'] = []
+            for _ in range(poisson(rng, args.answers)):
+                a = {'id': new_id(), 'parent_id': q['id'], 'owner_user_id': user(), 'score': poisson(rng, 2),
+                     'body': make_text(rng, vocab, args.text_words, True), 'creation_date': new_date()}
+                a['comments'] = comments(a['id'])
+                a['comment_count'] = len(a['comments'])
+                q['answers'].append(a)
+            json.dump(q, outp)
+            outp.write('\n')
+
+def make_tiny_model(path, vocab):
+    '''Saves a randomly initialized 2-layer RoBERTa classifier with a word-level tokenizer, built offline'''
+    tokens = ['<s>', '<pad>', '</s>', '<unk>'] + vocab + list('.,;:!?()[]{}=`"\'/-_*<>#')
+    tok = Tokenizer(models.WordLevel({t: i for i, t in enumerate(tokens)}, unk_token='<unk>'))
+    tok.pre_tokenizer = pre_tokenizers.Whitespace()
+    tok.post_processor = processors.TemplateProcessing(single='<s> $A </s>', special_tokens=[('<s>', 0), ('</s>', 2)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, bos_token='<s>', eos_token='</s>', pad_token='<pad>',
+                                        unk_token='<unk>', model_max_length=512)
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = RobertaConfig(vocab_size=len(tokens), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                           intermediate_size=64, max_position_embeddings=514, num_labels=3, pad_token_id=1)
+    RobertaForSequenceClassification(config).save_pretrained(path)
+
+def reset_peak_rss():
+    'Resets the kernel peak RSS counter (VmHWM), when allowed'
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 #Never reset: peak of the whole run
+
+def measure(name, fn, results):
+    '''Runs fn, which returns {counter: amount}, recording its time, throughput and peak RSS'''
+    reset_peak_rss()
+    start = time.perf_counter()
+    counts = fn()
+    seconds = time.perf_counter() - start
+    results[name] = {'seconds': round(seconds, 4), 'peak_rss_mb': round(peak_rss_mb(), 1), **counts,
+                     **{f'{k}_per_sec': round(v / seconds, 1) for k, v in counts.items() if seconds > 0}}
+    print(f"{name}: {seconds:.3f}s | " + ', '.join(f'{v} {k}' for k, v in counts.items()) + f" | peak RSS {results[name]['peak_rss_mb']} MB")
+
+def clean_stage(dump, cleaned):
+    lines = 0
+    with open(dump, 'r') as inp, open(cleaned, 'w') as outp:
+        for line in inp:
+            outp.write(cleaner.clean_line(line))
+            lines += 1
+    return {'lines': lines}
+
+def classify_stage(cleaned, analyzed, model_path, max_tokens):
+    model_parser = argparse.ArgumentParser()
+    classifier.add_model_args(model_parser)
+    classifier.load_model(model_parser.parse_args(['--model', model_path]))
+
+    lines = texts = 0
+    with open(cleaned, 'r') as inp, open(analyzed, 'w') as outp:
+        chunk = []
+        for line in inp:
+            chunk.append(json.loads(line))
+            if len(chunk) == 256:
+                texts += len(classifier.classify_posts(chunk, max_tokens)[0])
+                lines += len(chunk)
+                outp.writelines(json.dumps(obj) + '\n' for obj in chunk)
+                chunk = []
+        if chunk:
+            texts += len(classifier.classify_posts(chunk, max_tokens)[0])
+            lines += len(chunk)
+            outp.writelines(json.dumps(obj) + '\n' for obj in chunk)
+    return {'lines': lines, 'texts': texts}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(path, run):
+    'Prints the speedup of every stage against the previous run of the same configuration'
+    previous = None
+    if os.path.exists(path):
+        with open(path, 'r') as inp:
+            for line in inp:
+                entry = json.loads(line)
+                if entry['config'] == run['config']:
+                    previous = entry
+    if previous is None:
+        print('No previous run with this configuration')
+        return
+    print(f"Compared with {previous['commit']} ({previous['date']}):")
+    for name, stage in run['stages'].items():
+        if name in previous['stages']:
+            before = previous['stages'][name]
+            print(f"  {name}: {before['seconds']:.3f}s -> {stage['seconds']:.3f}s ({before['seconds'] / max(stage['seconds'], 1e-9):.2f}x), "
+                  f"peak RSS {before['peak_rss_mb']} -> {stage['peak_rss_mb']} MB")
+
+if __name__ == '__main__':
+    args = parse_args()
+    stages = args.stages.split(',')
+    workdir = args.workdir or tempfile.mkdtemp(prefix='so-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    dump, cleaned, analyzed = (os.path.join(workdir, f) for f in ['dump.jsonl', 'cleaned.jsonl', 'analyzed.jsonl'])
+    model_path = os.path.join(workdir, 'tiny-model')
+
+    make_dump(dump, args)
+    make_tiny_model(model_path, make_vocab(args.vocab))
+    print(f"Synthetic dump: {args.posts} posts, {os.path.getsize(dump) / 2**20:.1f} MB in {workdir}")
+
+    #Each stage reads the previous stage's output, stages that are not timed still run when a later one needs them
+    results, loaded = {}, {}
+    def run_stage(name, fn):
+        if name in stages:
+            measure(name, fn, results)
+        else:
+            fn()
+
+    def load_dict():
+        loaded['posts'] = helper.load_post_data(analyzed)
+        return {'posts': len(loaded['posts'])}
+    def load_store():
+        loaded['store'] = helper.PostStore.build(analyzed)
+        return {'items': len(loaded['store'])}
+    def aggregate_dict():
+        post_data = loaded['posts']
+        helper.get_users_average_sentiment(post_data, 1)
+        for post in post_data.values():
+            helper.get_post_average_sentiment(post)
+            helper.min_sentiment(post)
+        helper.get_user_to_interaction_posts_dict(post_data)
+        return {'posts': len(post_data)}
+    def aggregate_store():
+        store = loaded['store']
+        helper.get_users_sentiment_stats(store)
+        helper.get_threads_sentiment_stats(store)
+        helper.get_tags_sentiment_stats(store)
+        helper.get_user_interactions(store)
+        return {'items': len(store)}
+    def metrics():
+        _, report = analyze.run_metrics(analyzed, list(analyze.METRICS))
+        return {'lines': report['lines']}
+
+    needed = set(stages)
+    for name, fn, needs in [('clean', lambda: clean_stage(dump, cleaned), STAGES[1:]),
+                            ('classify', lambda: classify_stage(cleaned, analyzed, model_path, args.max_tokens), STAGES[2:]),
+                            ('load_dict', load_dict, ['aggregate_dict']), ('load_store', load_store, ['aggregate_store']),
+                            ('aggregate_dict', aggregate_dict, []), ('aggregate_store', aggregate_store, []), ('metrics', metrics, [])]:
+        if name in needed or needed & set(needs):
+            run_stage(name, fn)
+
+    run = {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+           'python': platform.python_version(), 'torch': torch.__version__, 'cpus': os.cpu_count(),
+           'config': {k: getattr(args, k) for k in ['posts', 'answers', 'comments', 'text_words', 'tags', 'users', 'vocab', 'seed', 'max_tokens']},
+           'stages': results}
+    if args.compare:
+        compare(args.o, run)
+    with open(args.o, 'a') as outp:
+        outp.write(json.dumps(run) + '\n')
@@ -1,82 +1,424 @@
 from scipy.special import softmax
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from backends import BACKENDS, load_backend
+from instrument import add_metrics_args, configure_from_args, init_worker_metrics, metrics
+from jsonl_io import POST, COMMENT, loads
+from probs_store import make_records
+from sentiment_cache import SentimentCache
+from text_cache import get_or_compute
+from token_store import TokenStore
 import argparse
+import contextlib
 import json
+import multiprocessing as mp
 import numpy as np
+import os
+import shutil
 import torch
 import time
 from datetime import datetime, timedelta
 
+MODEL = 'Cloudy1225/stackoverflow-roberta-base-sentiment'
+
+def add_model_args(parser):
+    '''Options shared by every entry point that loads the model'''
+    parser.add_argument('--model', type=str, help='Model name or local path', default=MODEL)
+    parser.add_argument('--backend', type=str, choices=BACKENDS, default='eager', help='Inference backend')
+    parser.add_argument('--int8', action='store_true', help='Use dynamic int8 quantization')
+    parser.add_argument('--export-dir', type=str, default='./exported', help='Where exported graphs are cached')
+    parser.add_argument('--max-tokens', type=int, default=8192, help='Token budget (padded) per batch, in batched mode')
+    parser.add_argument('--cache', type=str, default=None, help='SQLite file caching labels by text + model')
+    parser.add_argument('--cache-size', type=int, default=100000, help='Entries kept in the in-memory LRU in front of the cache')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads per worker (default: cores / workers)')
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-i', type=str, help='Input JSONL file', required=True)
+    parser.add_argument('-o', type=str, help='Output JSONL file', default='./analyzed.jsonl')
+    add_model_args(parser)
+    parser.add_argument('--batched', action='store_true', help='Use length-bucketed batched inference')
+    parser.add_argument('--chunk-lines', type=int, default=256, help='JSONL lines gathered per chunk, in batched mode')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes, each with its own model')
+    parser.add_argument('--checkpoint-every', type=int, default=1000, help='Lines between checkpoints of the input/output offsets')
+    parser.add_argument('--resume', action='store_true', help='Resume from the checkpoint next to the output file')
+    parser.add_argument('--probs', type=str, default=None, help='Also write the class probabilities of every text to this side file')
+    parser.add_argument('--tokens', type=str, default=None, help='Directory written by pretokenize.py, used instead of tokenizing again')
+    parser.add_argument('--allow-stale-tokens', action='store_true', help='Use --tokens even if they were made from a different input file')
+    add_metrics_args(parser)
 
     return parser.parse_args()
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+cache = None
+token_store = None
 
-def classify_sentiment(tokenizer, model, text):
-    encoded_input = tokenizer(text, return_tensors='pt', truncation=True, max_length=512)
+def sentiment_scores(tokenizer, model, text):
+    'Softmax scores of a single text'
+    with metrics.time('tokenize'):
+        encoded_input = tokenizer(text, return_tensors='pt', truncation=True, max_length=512)
+    metrics.count('tokens', encoded_input['input_ids'].shape[1])
     encoded_input = {k: v.to(device) for k, v in encoded_input.items()}
-    output = model(**encoded_input)
+    with metrics.time('forward'):
+        output = model(**encoded_input)
     scores = output[0][0].detach().cpu().numpy()
-    scores = softmax(scores)
-    return int(np.argmax(scores))
+    return softmax(scores)
+
+def classify_sentiment(tokenizer, model, text):
+    return int(np.argmax(sentiment_scores(tokenizer, model, text)))
 
 def classify_post(post):
+    classify_posts([post], batched=False)
+
+def collect_texts(post, targets):
+    '''Appends (object, key, text) for every text of the post tree, in the same order as classify_post'''
     if 'answers' in post:
-        augmented = post['title'] + '\n' + post['body']
-        post['body_sentiment'] = classify_sentiment(tokenizer, model, augmented)
+        targets.append((post, 'body_sentiment', post['title'] + '\n' + post['body']))
         for a in post['answers']:
-            classify_post(a)
+            collect_texts(a, targets)
     else:
-        post['body_sentiment'] = classify_sentiment(tokenizer, model, post['body'])
+        targets.append((post, 'body_sentiment', post['body']))
 
     for c in post['comments']:
-        c['text_sentiment'] = classify_sentiment(tokenizer, model, c['text'])
+        targets.append((c, 'text_sentiment', c['text']))
 
-if __name__ == '__main__':
-    MODEL = 'Cloudy1225/stackoverflow-roberta-base-sentiment'
-    tokenizer = AutoTokenizer.from_pretrained(MODEL)
-    model = AutoModelForSequenceClassification.from_pretrained(MODEL)
-    model.to(device)
+def make_batches(lengths, max_tokens):
+    '''Groups indexes into length-sorted batches, so that (batch size * longest length) fits the token budget'''
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    cur, cur_max = [], 0
+    for i in order:
+        new_max = max(cur_max, lengths[i])
+        if cur and new_max * (len(cur) + 1) > max_tokens:
+            batches.append(cur)
+            cur, new_max = [], lengths[i]
+        cur.append(i)
+        cur_max = new_max
+    if cur:
+        batches.append(cur)
+    return batches
+
+def pad_batch(tokenizer, seqs):
+    '''input_ids and attention_mask tensors of token id sequences (lists or int32 arrays), padded like tokenizer.pad'''
+    width = max(len(s) for s in seqs)
+    input_ids = np.full((len(seqs), width), tokenizer.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(seqs), width), dtype=np.int64)
+    for row, s in enumerate(seqs):
+        cols = slice(width - len(s), width) if tokenizer.padding_side == 'left' else slice(0, len(s))
+        input_ids[row, cols] = s
+        attention_mask[row, cols] = 1
+    return {'input_ids': torch.from_numpy(input_ids), 'attention_mask': torch.from_numpy(attention_mask)}
+
+def batch_scores(tokenizer, model, texts, max_tokens=8192):
+    '''Softmax scores of a list of texts, run with length-bucketed batches, as an (n, classes) array in input order'''
+    with metrics.time('tokenize'):
+        encoded = tokenizer(texts, truncation=True, max_length=512)['input_ids']
+    return encoded_scores(tokenizer, model, encoded, max_tokens)
+
+def encoded_scores(tokenizer, model, encoded, max_tokens=8192):
+    '''Same as batch_scores, for texts that are already token id sequences'''
+    lengths = [len(e) for e in encoded]
+    metrics.count('tokens', sum(lengths))
+    scores = [None] * len(encoded)
+
+    with torch.inference_mode():
+        for batch in make_batches(lengths, max_tokens):
+            padded = pad_batch(tokenizer, [encoded[i] for i in batch])
+            padded = {k: v.to(device) for k, v in padded.items()}
+            with metrics.time('forward'):
+                probs = torch.softmax(model(**padded)[0].float(), dim=-1).cpu().numpy()
+            metrics.count('batches')
+            for i, p in zip(batch, probs):
+                scores[i] = p
+
+    return np.array(scores)
+
+def classify_batch(tokenizer, model, texts, max_tokens=8192):
+    '''Classifies a list of texts with length-bucketed batches, returning labels in input order'''
+    return batch_scores(tokenizer, model, texts, max_tokens).argmax(axis=1).tolist()
+
+def stored_scores(texts, keys, max_tokens=8192):
+    '''
+    Softmax scores of texts with their input ids read from the token store by (kind, id),
+    tokenizing only the texts that are not in it. max_tokens=0 runs one text per batch.
+    '''
+    encoded = token_store.get_many([k for k, _ in keys], [i for _, i in keys])
+    absent = [i for i, e in enumerate(encoded) if e is None]
+    metrics.count('stored_texts', len(encoded) - len(absent))
+    if absent:
+        with metrics.time('tokenize'):
+            for i, e in zip(absent, tokenizer([texts[i] for i in absent], truncation=True, max_length=token_store.max_length)['input_ids']):
+                encoded[i] = e
+    return encoded_scores(tokenizer, model, encoded, max_tokens)
+
+def target_kind(key):
+    return POST if key == 'body_sentiment' else COMMENT
+
+def classify_posts(posts, max_tokens=8192, batched=True):
+    '''
+    Classifies every text of a list of posts at once, writing labels back into the post trees.
+    Returns the (object, key, text) targets and their softmax scores, in the same order.
+    '''
+    targets = []
+    for post in posts:
+        collect_texts(post, targets)
+
+    texts = [t[2] for t in targets]
+    metrics.count('texts', len(texts))
+
+    def compute(missing):
+        'Runs the model once per distinct uncached text'
+        metrics.count('model_texts', len(missing))
+        if token_store is not None:
+            keys = {}
+            for obj, key, text in targets:
+                keys.setdefault(text, (target_kind(key), obj['id']))
+            scores = stored_scores(missing, [keys[t] for t in missing], max_tokens if batched else 0)
+        elif batched:
+            scores = batch_scores(tokenizer, model, missing, max_tokens)
+        else:
+            scores = [sentiment_scores(tokenizer, model, t) for t in missing]
+        return [(int(np.argmax(s)), s) for s in scores]
+
+    entries = get_or_compute(cache, texts, compute)
+
+    for (obj, key, _), (label, _) in zip(targets, entries):
+        obj[key] = label
+
+    return targets, np.array([e[1] for e in entries]).reshape(len(entries), -1)
+
+def probability_records(targets, scores):
+    kinds = [target_kind(key) for _, key, _ in targets]
+    return make_records(kinds, [obj['id'] for obj, _, _ in targets], scores)
+
+def read_chunks(inp, size, end=None):
+    '''Yields (lines, offset) with up to `size` parsed lines and the byte offset right after them, stopping at `end'''
+    pos = inp.tell()
+    chunk = []
+    for line in inp:
+        if end is not None and pos >= end:
+            break
+        pos += len(line)
+        chunk.append(loads(line))
+        if len(chunk) >= size:
+            yield chunk, pos
+            chunk = []
+    if chunk:
+        yield chunk, pos
+
+def load_model(args):
+    'Loads the model and points `device` at where its backend runs (the CPU for int8 and exported models)'
+    global tokenizer, model, device
+    tokenizer, model, device = load_backend(args.model, args.backend, args.int8, args.export_dir, args.threads, device)
+
+def model_identity(args):
+    'Names the exact scores a run produces: quantized or exported models only approximate the eager fp32 one'
+    return f'{args.model}|{args.backend}|int8={args.int8}'
+
+def open_cache(args):
+    global cache
+    if args.cache is not None:
+        cache = SentimentCache(args.cache, model_identity(args), args.cache_size)
+
+def open_token_store(args):
+    '''Maps the pre-tokenized shards of args.tokens, checking that they were made with the same tokenizer'''
+    global token_store
+    if args.tokens is None:
+        return
+    token_store = TokenStore(args.tokens)
+    if token_store.model != args.model:
+        raise ValueError(f'{args.tokens} was tokenized for {token_store.model}, not {args.model}')
+    #Texts are looked up by id, so ids tokenized from another version of the input would give stale tokens
+    stat = os.stat(args.i)
+    if (token_store.meta['input_size'], token_store.meta.get('input_mtime')) != (stat.st_size, stat.st_mtime_ns):
+        if not args.allow_stale_tokens:
+            raise ValueError(f"{args.tokens} was tokenized from {token_store.meta['input']}, which differs from {args.i} "
+                             f"(size or modification time), pass --allow-stale-tokens to use it anyway")
+        print(f"Warning: {args.tokens} was tokenized from {token_store.meta['input']}, which differs from {args.i}")
+
+def report_progress(name, processed_lines, processed_texts, start_time, pos, resumed_at, start, end):
+    '''Prints progress over the byte range [start, end), with the ETA based on the bytes done since resumed_at'''
+    elapsed_time = time.time() - start_time
+    progress_percent = ((pos - start) / (end - start)) * 100 if end > start else 100.0
+    eta_seconds = (end - pos) * elapsed_time / (pos - resumed_at) if pos > resumed_at else 0
+    eta = datetime.now() + timedelta(seconds=eta_seconds)
+
+    print(f"{name}Progress: {processed_lines} lines ({progress_percent:.1f}%) | "
+          f"Elapsed: {timedelta(seconds=int(elapsed_time))} | "
+          f"ETA: {eta.strftime('%Y-%m-%d %H:%M:%S')} | "
+          f"Rate: {processed_lines/elapsed_time:.1f} lines/sec, {processed_texts/elapsed_time:.1f} texts/sec")
+
+def load_checkpoint(path):
+    '''Returns the checkpoint stored in the sidecar file `path`, or None if there is none'''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_checkpoint(path, ckpt):
+    '''Atomically replaces the sidecar checkpoint file'''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(ckpt, f)
+    os.replace(path + '.tmp', path)
+
+def classify_range(in_path, out_path, args, start=0, end=None, name='', probs_path=None):
+    '''
+    Classifies the lines of in_path that start within [start, end), writing them to out_path
+    and, if probs_path is given, the probability records of every text to probs_path.
+    Every `args.checkpoint_every` lines, the input and output offsets are saved to `out_path + '.ckpt'`,
+    so that a run with `args.resume` continues from there instead of starting over.
+    '''
+    if end is None:
+        end = os.path.getsize(in_path)
+    ckpt_path = out_path + '.ckpt'
+    ckpt = load_checkpoint(ckpt_path) if args.resume else None
+
+    if ckpt is not None:
+        if (ckpt['input'], ckpt['start'], ckpt['end']) != (os.path.abspath(in_path), start, end):
+            raise ValueError(f'Checkpoint {ckpt_path} does not match the input range, refusing to resume')
+        #Texts were classified but no probability records kept, so the probabilities file would miss them
+        if probs_path and ckpt['texts'] > 0 and ckpt.get('probs_offset', 0) == 0:
+            raise ValueError(f'Checkpoint {ckpt_path} was written without --probs, refusing to resume with it')
+        print(f"{name}Resuming from input offset {ckpt['in_offset']} ({ckpt['lines']} lines already done)")
+    else:
+        ckpt = {'input': os.path.abspath(in_path), 'start': start, 'end': end,
+                'in_offset': start, 'out_offset': 0, 'probs_offset': 0, 'lines': 0, 'texts': 0}
 
-    args = parse_args()
-    
-    with open(args.i, 'r') as f:
-        total_lines = sum(1 for _ in f)
-    
     start_time = time.time()
     processed_lines = 0
-    
-    with open(args.i, 'r') as inp:
-        with open('./analyzed.jsonl', 'w') as outp:
-            for line in inp:
-                obj = json.loads(line)
-                classify_post(obj)
-                json.dump(obj, outp)
-                outp.write('\n')
-                
-                processed_lines += 1
-                
-                if processed_lines % 10000 == 0:
-                    current_time = time.time()
-                    elapsed_time = current_time - start_time
-                    
-                    progress_percent = (processed_lines / total_lines) * 100
-                    
-                    if processed_lines > 0:
-                        avg_time_per_line = elapsed_time / processed_lines
-                        remaining_lines = total_lines - processed_lines
-                        eta_seconds = remaining_lines * avg_time_per_line
-                        eta = datetime.now() + timedelta(seconds=eta_seconds)
-                        
-                        print(f"Progress: {processed_lines}/{total_lines} ({progress_percent:.1f}%) | "
-                              f"Elapsed: {timedelta(seconds=int(elapsed_time))} | "
-                              f"ETA: {eta.strftime('%Y-%m-%d %H:%M:%S')} | "
-                              f"Rate: {processed_lines/elapsed_time:.1f} lines/sec")
+    processed_texts = 0
+    next_report = 10000
+    next_checkpoint = args.checkpoint_every
+    done_lines, done_texts = ckpt['lines'], ckpt['texts']
+    resumed_at = ckpt['in_offset']
+
+    def checkpoint(pos):
+        outp.flush()
+        os.fsync(outp.fileno())
+        if probs_out is not None:
+            probs_out.flush()
+            os.fsync(probs_out.fileno())
+            ckpt['probs_offset'] = probs_out.tell()
+        ckpt.update(in_offset=pos, out_offset=outp.tell(),
+                    lines=done_lines + processed_lines, texts=done_texts + processed_texts)
+        save_checkpoint(ckpt_path, ckpt)
+        if cache is not None:
+            cache.commit()
+
+    probs_offset = ckpt.get('probs_offset', 0)
+    probs_file = open(probs_path, 'r+b' if probs_offset > 0 else 'wb') if probs_path else contextlib.nullcontext()
+
+    with open(in_path, 'rb') as inp, probs_file as probs_out:
+        #Drop whatever was written after the last checkpoint
+        with open(out_path, 'r+' if ckpt['out_offset'] > 0 else 'w') as outp:
+            outp.seek(ckpt['out_offset'])
+            outp.truncate()
+            if probs_out is not None:
+                probs_out.seek(probs_offset)
+                probs_out.truncate()
+            inp.seek(resumed_at)
+
+            for chunk, pos in read_chunks(inp, args.chunk_lines if args.batched else 1, end):
+                targets, scores = classify_posts(chunk, args.max_tokens, args.batched)
+                processed_texts += len(targets)
+
+                if probs_out is not None:
+                    probs_out.write(probability_records(targets, scores).tobytes())
+
+                with metrics.time('json_encode'):
+                    for obj in chunk:
+                        json.dump(obj, outp)
+                        outp.write('\n')
+
+                processed_lines += len(chunk)
+                metrics.count('lines', len(chunk))
+
+                if processed_lines >= next_checkpoint:
+                    next_checkpoint += args.checkpoint_every
+                    checkpoint(pos)
+
+                if processed_lines >= next_report:
+                    next_report += 10000
+                    report_progress(name, processed_lines, processed_texts, start_time, pos, resumed_at, start, end)
+
+            checkpoint(end)
+
+    if cache is not None:
+        cache.commit()
+        print(f'{name}{cache.stats()}')
+
+    return processed_lines, processed_texts
+
+def shard_ranges(path, n):
+    '''Splits a JSONL file into n byte ranges, each boundary moved forward to the start of a line'''
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, n):
+            f.seek(max(size * k // n, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline() #Finish the line we landed in
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def classify_shard(job):
+    '''Worker entry point: loads its own model with pinned threads and classifies one byte range'''
+    k, start, end, args = job
+    torch.set_num_threads(args.threads)
+    load_model(args)
+    open_cache(args)
+    open_token_store(args)
+    probs_path = f'{args.probs}.part{k}' if args.probs else None
+    return classify_range(args.i, f'{args.o}.part{k}', args, start, end, f'[worker {k}] ', probs_path)
+
+def merge_parts(path, n):
+    'Concatenates path.part0 ... path.part{n-1} into path, then removes the parts'
+    with open(path, 'wb') as outp:
+        for k in range(n):
+            with open(f'{path}.part{k}', 'rb') as part:
+                shutil.copyfileobj(part, outp)
+    for k in range(n):
+        os.remove(f'{path}.part{k}')
+
+def classify_parallel(args):
+    '''Classifies args.i with args.workers processes and merges the shards in input order'''
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+    jobs = [(k, s, e, args) for k, (s, e) in enumerate(shard_ranges(args.i, args.workers))]
+
+    with mp.get_context('spawn').Pool(args.workers, initializer=init_worker_metrics, initargs=(args,)) as pool:
+        results = pool.map(classify_shard, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+
+    #Ordered merge. Checkpoints are only removed once every shard is done, so a failed run can still resume
+    merge_parts(args.o, len(jobs))
+    if args.probs:
+        merge_parts(args.probs, len(jobs))
+    for k in range(len(jobs)):
+        os.remove(f'{args.o}.part{k}.ckpt')
+
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+if __name__ == '__main__':
+    args = parse_args()
+    start_time = time.time()
+    configure_from_args(args)
+
+    if args.workers > 1:
+        processed_lines, processed_texts = classify_parallel(args)
+    else:
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+        load_model(args)
+        open_cache(args)
+        open_token_store(args)
+        processed_lines, processed_texts = classify_range(args.i, args.o, args, probs_path=args.probs)
+        #Done: a later run on a regenerated input must not resume from these offsets
+        os.remove(args.o + '.ckpt')
     
     total_time = time.time() - start_time
-    print(f"\nProcessed {processed_lines} lines in {timedelta(seconds=int(total_time))}")
-    print(f"Average rate: {processed_lines/total_time:.1f} lines/sec")
+    print(f"\nProcessed {processed_lines} lines ({processed_texts} texts) in {timedelta(seconds=int(total_time))}")
+    print(f"Average rate: {processed_lines/total_time:.1f} lines/sec, {processed_texts/total_time:.1f} texts/sec "
+          f"({'batched' if args.batched else 'per-text'}, {args.workers} worker(s))")
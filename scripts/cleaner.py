@@ -1,8 +1,17 @@
 from bs4 import BeautifulSoup, Comment
 from markdown import markdown
+from instrument import add_metrics_args, configure_from_args, init_worker_metrics, metrics
+from jsonl_io import open_jsonl, loads, dumps
+from multiprocessing import Pool
 import validators
 import argparse
 import json
+import random
+import sys
+
+#BeautifulSoup tree builder, 'lxml' is a much faster C parser (see --check-parser)
+PARSERS = ['html.parser', 'lxml']
+parser = 'html.parser'
 
 def clean_stackoverflow_post(html_text):
     """
@@ -14,7 +23,7 @@ def clean_stackoverflow_post(html_text):
     Returns:
         A cleaned string.
     """
-    soup = BeautifulSoup(html_text, 'html.parser')
+    soup = BeautifulSoup(html_text, parser)
 
     # 1. Remove script and style tags completely
     for script_or_style in soup(['script', 'style']):
@@ -54,7 +63,7 @@ def clean_comment(md_text):
         html = markdown(md_text)
     except: #Malformatted markdown...
         return ''
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, parser)
 
     #Also replace code blocks
     for code_tag in soup.find_all('code'):
@@ -72,7 +81,8 @@ def clean_comment(md_text):
 
 def clean_post(post):
     #Clean the body
-    post['body'] = clean_stackoverflow_post(post['body'])
+    with metrics.time('html_parse'):
+        post['body'] = clean_stackoverflow_post(post['body'])
 
     #Clean answers, if they exist
     if 'answers' in post:
@@ -81,22 +91,112 @@ def clean_post(post):
 
     #Clean comments
     for c in post['comments']:
-        c['text'] = clean_comment(c['text'])
+        with metrics.time('markdown'):
+            c['text'] = clean_comment(c['text'])
+    metrics.count('texts', 1 + len(post['comments']))
     #Filter empty comments from cleaning
     post['comments'] = list(filter(lambda x : x['text'] != '', post['comments']))
 
+def set_parser(name):
+    global parser
+    parser = name
+
+def init_worker(name, args):
+    'Pool initializer: sets the parser and gives each worker its own metrics file'
+    set_parser(name)
+    init_worker_metrics(args)
+
+def clean_line(line):
+    'Cleans one raw JSONL line, returning the cleaned JSONL line'
+    obj = loads(line)
+    clean_post(obj)
+    metrics.count('lines')
+    with metrics.time('json_encode'):
+        return dumps(obj)
+
+def collect_cleaned(post, texts):
+    '''Appends every cleaned text of a post tree, in a fixed order'''
+    texts.append(post['body'])
+    for a in post.get('answers', []):
+        collect_cleaned(a, texts)
+    for c in post['comments']:
+        texts.append(c['text'])
+
+def sample_lines(path, sample, seed=0):
+    'Uniform random sample of (line number, line) over the whole file, in file order (reservoir sampling)'
+    rng = random.Random(seed)
+    reservoir, total = [], 0
+    with open_jsonl(path, 'r') as inp:
+        for n, line in enumerate(inp):
+            total += 1
+            if len(reservoir) < sample:
+                reservoir.append((n, line))
+            else:
+                k = rng.randrange(total)
+                if k < sample:
+                    reservoir[k] = (n, line)
+    return sorted(reservoir), total
+
+def check_parser(path, candidate, sample=1000, show=5, seed=0):
+    '''
+    Cleans `sample` lines drawn at random from the whole of path with html.parser and with `candidate`,
+    printing up to `show` texts that differ. Returns the number of differing texts.
+    '''
+    lines, total_lines = sample_lines(path, sample, seed)
+    diffs = total = 0
+    for n, line in lines:
+        outputs = []
+        for name in ['html.parser', candidate]:
+            set_parser(name)
+            texts = []
+            collect_cleaned(json.loads(clean_line(line)), texts)
+            outputs.append(texts)
+
+        if len(outputs[0]) != len(outputs[1]): #Different comments got filtered as empty
+            width = max(len(outputs[0]), len(outputs[1]))
+            outputs = [o + [None] * (width - len(o)) for o in outputs]
+        for ref, new in zip(*outputs):
+            total += 1
+            if ref != new:
+                diffs += 1
+                if diffs <= show:
+                    print(f'--- html.parser (line {n + 1})\n{ref}\n+++ {candidate}\n{new}\n')
+
+    if diffs > show:
+        print(f'({diffs - show} more differing texts not shown)')
+    print(f'{candidate}: checked {total} cleaned texts from {len(lines)} of {total_lines} lines, '
+          f'{diffs} differ from html.parser ({diffs / max(total, 1) * 100:.2f}%)')
+    return diffs
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-i', type=str, help='Path to dump', required=True)
-    args = parser.parse_args()
-
-    with open(args.i, 'r') as inp:
-        with open('./cleaned.jsonl', 'w') as outp:
-            for line in inp:
-                #Load the object
-                obj = json.loads(line)
-
-                #Clean posts recursively
-                clean_post(obj)
-                json.dump(obj, outp)
-                outp.write('\n')
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', type=str, help='Path to dump', required=True)
+    arg_parser.add_argument('-o', type=str, help='Output file', default='./cleaned.jsonl')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Number of cleaning processes')
+    arg_parser.add_argument('--chunk-lines', type=int, default=64, help='Lines sent to a worker at a time')
+    arg_parser.add_argument('--parser', type=str, choices=PARSERS, default='html.parser', help='BeautifulSoup parser')
+    arg_parser.add_argument('--check-parser', type=int, default=None, metavar='N',
+                            help='Only compare --parser against html.parser on N lines sampled across the file')
+    arg_parser.add_argument('--check-show', type=int, default=5, help='Differing texts printed by --check-parser')
+    arg_parser.add_argument('--check-seed', type=int, default=0, help='Random seed of the --check-parser sample')
+    add_metrics_args(arg_parser)
+    args = arg_parser.parse_args()
+
+    if args.check_parser is not None:
+        sys.exit(1 if check_parser(args.i, args.parser, args.check_parser, args.check_show, args.check_seed) else 0)
+
+    set_parser(args.parser)
+    with open_jsonl(args.i, 'r') as inp:
+        with open_jsonl(args.o, 'w') as outp:
+            if args.workers > 1:
+                #imap keeps the input order, while workers clean chunks ahead
+                with Pool(args.workers, initializer=init_worker, initargs=(args.parser, args)) as pool:
+                    configure_from_args(args) #After the fork, so workers start with empty metrics
+                    for line in pool.imap(clean_line, inp, chunksize=args.chunk_lines):
+                        outp.write(line)
+                        metrics.count('lines_written')
+                    pool.close()
+                    pool.join()
+            else:
+                configure_from_args(args)
+                outp.writelines(map(clean_line, inp))
@@ -1,13 +1,33 @@
 import argparse
+import itertools
 import json
+import operator
+import os
+import shutil
 import psycopg as psy
+from datetime import datetime
+from instrument import add_metrics_args, configure_from_args, init_worker_metrics, metrics
+from json.encoder import encode_basestring_ascii
+from jsonl_io import open_jsonl, with_suffix, dumps
+from multiprocessing import Pool
 from psycopg.rows import dict_row
 
+DSN = "dbname=stackoverflow user=postgres"
+BATCH_SIZE = 10000
+
+q_fields = ['id', 'owner_user_id', 'score', 'tags', 'title', 'body', 'comment_count', 'creation_date']
+ans_fields = ['id', 'parent_id', 'owner_user_id', 'score', 'body', 'comment_count', 'creation_date']
+comm_fields = ['id', 'post_id', 'user_id', 'score', 'text', 'creation_date']
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-n', type=int, help='Number of posts to be parsed', required = True)
     parser.add_argument('-o', type=str, help='Output file', required=True)
+    parser.add_argument('--workers', type=int, default=1, help='Years extracted in parallel, each with its own connection')
+    parser.add_argument('--merge', action='store_true', help='In parallel mode, merge the per-year shards into the output file')
+    parser.add_argument('--copy', action='store_true', help='Stream rows with binary COPY and join them in order (takes the lowest ids of each year)')
+    add_metrics_args(parser)
 
     return parser.parse_args()
 
@@ -26,71 +46,212 @@ def treat_comment(comment):
     
     return comment
 
+def export_year(conn, year, limit, output):
+    """Writes up to `limit` questions created in `year`, with their answers and comments. Returns (posts, comments)"""
+    question_cur = conn.cursor(name=f'question_cur_{year}')
+    bulk_cur = conn.cursor(name=f'bulk_cur_{year}')
+    num_posts = 0
+    num_comments = 0
+
+    #Range predicate instead of extract(year ...), so that an index on creation_date can be used
+    query = question_cur.execute(f"""SELECT {', '.join(q_fields)} FROM posts 
+                                    WHERE post_type_id = 1 AND (comment_count > 0 OR answer_count > 0)
+                                    AND creation_date >= %s AND creation_date < %s
+                                    LIMIT %s;
+                                """, (datetime(year, 1, 1), datetime(year + 1, 1, 1), limit,))
+    #Process all
+    while True:
+        with metrics.time('db_questions'):
+            data = query.fetchmany(BATCH_SIZE)
+        if not data: break #No data
+
+        qids = {q['id'] for q in data}
+
+        #Get all answers
+        with metrics.time('db_answers'):
+            raw_answers = bulk_cur.execute(f"""SELECT {', '.join(ans_fields)} FROM posts
+                                WHERE parent_id = ANY(%s) AND post_type_id = 2""", (list(qids),)).fetchall()
+        ans_ids = {a['id'] for a in raw_answers}
+        
+        #Get all comments from questions + answers
+        with metrics.time('db_comments'):
+            raw_comments = bulk_cur.execute(f"""SELECT {', '.join(comm_fields)} FROM comments
+                                            WHERE post_id = ANY(%s)
+                                            """, (list(qids.union(ans_ids)),)).fetchall()
+        
+        #Index everything, so we can append the comments easily
+        all_posts = {q['id']: treat_post(q) for q in data + raw_answers}
+
+        for c in raw_comments: #Add comments
+            all_posts[c['post_id']]['comments'].append(treat_comment(c))
+        
+        #Now add answer to questions
+        for q in data:
+            q['answers'] = []
+        
+        for ans in raw_answers:
+            all_posts[ans['parent_id']]['answers'].append(ans)
+
+        #Write out final obj
+        with metrics.time('json_encode'):
+            output.writelines(map(dumps, data))
+        
+        num_posts += len(data) + len(raw_answers)
+        num_comments += len(raw_comments)
+        metrics.count('questions', len(data))
+        metrics.count('posts', len(data) + len(raw_answers))
+        metrics.count('comments', len(raw_comments))
+
+    question_cur.close()
+    bulk_cur.close()
+    return num_posts, num_comments
+
+#Questions selected for a year. Ordered, so that every COPY stream sees the same selection
+SELECTED = """SELECT id FROM posts WHERE post_type_id = 1 AND (comment_count > 0 OR answer_count > 0)
+              AND creation_date >= %(lower)s AND creation_date < %(upper)s ORDER BY id LIMIT %(limit)s"""
+
+def copy_rows(conn, query, params):
+    """Streams the rows of a query as tuples, through COPY ... TO STDOUT (FORMAT BINARY)"""
+    with conn.cursor() as cur:
+        #Binary COPY needs the column types up front
+        cur.execute(f"SELECT * FROM ({query}) AS q LIMIT 0", params)
+        types = [d.type_code for d in cur.description]
+
+        with cur.copy(f"COPY ({query}) TO STDOUT (FORMAT BINARY)", params) as copy:
+            copy.set_types(types)
+            yield from copy.rows()
+
+#JSON of a column value, exactly as json.dumps writes it (dates as treat_post formats them)
+VALUE_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    bool: lambda v: 'true' if v else 'false',
+    type(None): lambda v: 'null',
+    datetime: lambda v: '"' + v.isoformat() + '"',
+}
+
+def row_encoder(fields):
+    """Returns a function encoding a row tuple as the comma separated JSON members of `fields` (extra trailing columns are ignored)"""
+    keys = [json.dumps(f) + ': ' for f in fields]
+    def encode(row):
+        return ', '.join([k + VALUE_ENCODERS.get(type(v), json.dumps)(v) for k, v in zip(keys, row)])
+    return encode
+
+encode_question, encode_answer, encode_comment = row_encoder(q_fields), row_encoder(ans_fields), row_encoder(comm_fields)
+
+def encode_tree(question, answers, comments):
+    """
+    The JSONL line of a question row with its answer rows and {post id: [encoded comments]},
+    byte-identical to what export_year writes for the same rows, without building any dict
+    """
+    answer_id = ans_fields.index('id')
+    encoded_answers = ['{' + encode_answer(a) + ', "comments": [' + ', '.join(comments.get(a[answer_id], ())) + ']}' for a in answers]
+    return ('{' + encode_question(question) + ', "comments": [' + ', '.join(comments.get(question[0], ())) +
+            '], "answers": [' + ', '.join(encoded_answers) + ']}\n')
+
+def export_year_copy(year, limit, output):
+    """
+    Same output as export_year, but questions, answers and comments come from three binary COPY streams
+    sorted by question id (one connection each), which are merge-joined without any per-row query.
+    Rows are encoded straight from their tuples.
+    """
+    params = {'lower': datetime(year, 1, 1), 'upper': datetime(year + 1, 1, 1), 'limit': limit}
+    conns = [psy.connect(DSN) for _ in range(3)]
+    num_posts = 0
+    num_comments = 0
+
+    questions = copy_rows(conns[0], f"""SELECT {', '.join(q_fields)} FROM posts
+                                        WHERE id IN ({SELECTED}) ORDER BY id""", params)
+    answers = copy_rows(conns[1], f"""SELECT {', '.join(ans_fields)} FROM posts
+                                      WHERE post_type_id = 2 AND parent_id IN ({SELECTED})
+                                      ORDER BY parent_id, id""", params)
+    #Comments of the questions and of their answers, tagged with the question id as the last column
+    comments = copy_rows(conns[2], f"""SELECT {', '.join('c.' + f for f in comm_fields)}, p.qid FROM comments c
+                                       JOIN (SELECT id, id AS qid FROM posts WHERE id IN ({SELECTED})
+                                             UNION ALL
+                                             SELECT id, parent_id FROM posts WHERE post_type_id = 2 AND parent_id IN ({SELECTED})
+                                       ) p ON c.post_id = p.id
+                                       ORDER BY p.qid, c.id""", params)
+
+    answer_groups = itertools.groupby(answers, key=operator.itemgetter(ans_fields.index('parent_id')))
+    comment_groups = itertools.groupby(comments, key=operator.itemgetter(len(comm_fields)))
+    next_answers = next(answer_groups, None)
+    next_comments = next(comment_groups, None)
+
+    post_id = comm_fields.index('post_id')
+    try:
+        for row in questions:
+            qid = row[0]
+            answers, comments = [], {}
+
+            if next_answers is not None and next_answers[0] == qid:
+                answers = list(next_answers[1])
+                next_answers = next(answer_groups, None)
+
+            if next_comments is not None and next_comments[0] == qid:
+                for c in next_comments[1]:
+                    comments.setdefault(c[post_id], []).append('{' + encode_comment(c) + '}')
+                    num_comments += 1
+                next_comments = next(comment_groups, None)
+
+            with metrics.time('json_encode'):
+                output.write(encode_tree(row, answers, comments))
+            num_posts += 1 + len(answers)
+            metrics.count('questions')
+            metrics.count('posts', 1 + len(answers))
+    finally:
+        for conn in conns:
+            conn.close()
+
+    return num_posts, num_comments
+
+def export_year_shard(job):
+    """Worker entry point: one connection and one output shard per year"""
+    year, limit, path, args = job
+    with open_jsonl(path, 'w') as output:
+        if args.copy:
+            result = export_year_copy(year, limit, output)
+        else:
+            with psy.connect(DSN, row_factory=dict_row) as conn:
+                result = export_year(conn, year, limit, output)
+    print(f"{year}: fetched {result[0]} posts and {result[1]} comments")
+    return result
+
 if __name__ == '__main__':
     args = parse_args()
 
-    conn = psy.connect("dbname=stackoverflow user=postgres", row_factory=dict_row)
-    question_cur = conn.cursor(name='question_cur')
-    bulk_cur = conn.cursor(name='bulk_cur')
-
-    with open(args.o, 'w') as output:
-        BATCH_SIZE = 10000
-
-        q_fields = ['id', 'owner_user_id', 'score', 'tags', 'title', 'body', 'comment_count', 'creation_date']
-        ans_fields = ['id', 'parent_id', 'owner_user_id', 'score', 'body', 'comment_count', 'creation_date']
-        comm_fields = ['id', 'post_id', 'user_id', 'score', 'text', 'creation_date']
-        num_posts = 0
-        num_comments = 0
-
-        #Define our years -> 2014-2024
-        lower, upper = 2014, 2024
-        years = range(2014,2024)
-        posts_per_year = args.n // (upper-lower)
-
-        for y in years:
-            query = question_cur.execute(f"""SELECT {', '.join(q_fields)} FROM posts 
-                                            WHERE post_type_id = 1 AND (comment_count > 0 OR answer_count > 0) AND extract(year from creation_date) = %s
-                                            LIMIT %s;
-                                        """, (y, posts_per_year,))
-            #Process all
-            while True:
-                data = query.fetchmany(BATCH_SIZE)
-                if not data: break #No data
-
-                qids = {q['id'] for q in data}
-
-                #Get all answers
-                raw_answers = bulk_cur.execute(f"""SELECT {', '.join(ans_fields)} FROM posts
-                                    WHERE parent_id = ANY(%s) AND post_type_id = 2""", (list(qids),)).fetchall()
-                ans_ids = {a['id'] for a in raw_answers}
-                
-                #Get all comments from questions + answers
-                raw_comments = bulk_cur.execute(f"""SELECT {', '.join(comm_fields)} FROM comments
-                                                WHERE post_id = ANY(%s)
-                                                """, (list(qids.union(ans_ids)),)).fetchall()
-                
-                #Index everything, so we can append the comments easily
-                all_posts = {q['id']: treat_post(q) for q in data + raw_answers}
-
-                for c in raw_comments: #Add comments
-                    all_posts[c['post_id']]['comments'].append(treat_comment(c))
-                
-                #Now add answer to questions
-                for q in data:
-                    q['answers'] = []
-                
-                for ans in raw_answers:
-                    all_posts[ans['parent_id']]['answers'].append(ans)
-
-                #Write out final obj
-                for q in data:
-                    json.dump(q, output)
-                    output.write('\n')
-                
-                num_posts += len(data) + len(raw_answers)
-                num_comments += len(raw_comments)
+    #Define our years -> 2014-2024
+    lower, upper = 2014, 2024
+    years = range(2014,2024)
+    posts_per_year = args.n // (upper-lower)
 
-    question_cur.close()
-    conn.close()
+    if args.workers > 1:
+        #Compressed shards are complete streams: concatenating them still gives a valid .zst/.gz file
+        jobs = [(y, posts_per_year, with_suffix(args.o, f'.{y}'), args) for y in years]
+        with Pool(args.workers, initializer=init_worker_metrics, initargs=(args,)) as pool:
+            configure_from_args(args) #After the fork, so workers start with empty metrics
+            results = pool.map(export_year_shard, jobs, chunksize=1)
+            pool.close()
+            pool.join()
+
+        if args.merge:
+            with open(args.o, 'wb') as output:
+                for _, _, path, _ in jobs:
+                    with open(path, 'rb') as shard:
+                        shutil.copyfileobj(shard, output)
+            for _, _, path, _ in jobs:
+                os.remove(path)
+    elif args.copy:
+        configure_from_args(args)
+        with open_jsonl(args.o, 'w') as output:
+            results = [export_year_copy(y, posts_per_year, output) for y in years]
+    else:
+        configure_from_args(args)
+        conn = psy.connect(DSN, row_factory=dict_row)
+        with open_jsonl(args.o, 'w') as output:
+            results = [export_year(conn, y, posts_per_year, output) for y in years]
+        conn.close()
 
-    print(f"Fetched {num_posts} posts and {num_comments} comments")
\ No newline at end of file
+    num_posts = sum(r[0] for r in results)
+    num_comments = sum(r[1] for r in results)
+    print(f"Fetched {num_posts} posts and {num_comments} comments")
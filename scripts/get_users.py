@@ -1,13 +1,22 @@
 import argparse
 import json
+import numpy as np
 import psycopg as psy
+from instrument import add_metrics_args, configure_from_args, metrics
+from jsonl_io import open_jsonl, loads
 from psycopg.rows import dict_row
 
+DSN = "dbname=stackoverflow user=postgres"
+cols = ['id', 'reputation', 'location', 'views', 'up_votes', 'down_votes', 'creation_date', 'last_access_date']
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-i', type=str, help='Path to dump', required=True)
     parser.add_argument('-o', type=str, help='Output file', required=True)
+    parser.add_argument('--chunked', action='store_true', help='Query users in bounded batches and stream them out as JSONL')
+    parser.add_argument('--batch-size', type=int, default=50000, help='User ids per query, in chunked mode')
+    add_metrics_args(parser)
 
     return parser.parse_args()
 
@@ -21,36 +30,114 @@ def get_ids(post, ids):
     for c in post['comments']:
         ids.add(c['user_id'])
 
+class IdSet:
+    """Set of integer ids, backed by a growable boolean array (one byte per possible id)"""
+    def __init__(self, capacity=1 << 20):
+        self.bits = np.zeros(capacity, dtype=bool)
+        self.negative = set() #e.g. the Community user, -1
+
+    def add_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        self.negative.update(ids[ids < 0].tolist())
+        ids = ids[ids >= 0]
+        if len(ids) == 0:
+            return
+        top = int(ids.max())
+        if top >= len(self.bits):
+            bits = np.zeros(max(top + 1, 2 * len(self.bits)), dtype=bool)
+            bits[:len(self.bits)] = self.bits
+            self.bits = bits
+        self.bits[ids] = True
+
+    def __len__(self):
+        return int(np.count_nonzero(self.bits)) + len(self.negative)
+
+    def sorted(self):
+        return np.concatenate([np.array(sorted(self.negative), dtype=np.int64), np.flatnonzero(self.bits)])
+
+def collect_ids(path, flush_every=100000):
+    """Reads every user id of the dump into an IdSet, without keeping a Python set of them"""
+    ids = IdSet()
+    buffer = set()
+    with open_jsonl(path, 'rb') as inp:
+        for line in inp:
+            get_ids(loads(line), buffer)
+            metrics.count('lines')
+            if len(buffer) >= flush_every:
+                buffer.discard(None)
+                ids.add_many(list(buffer))
+                buffer.clear()
+    buffer.discard(None)
+    ids.add_many(list(buffer))
+    return ids
+
+def treat_user(u):
+    #Convert time
+    u['creation_date'] = u['creation_date'].isoformat()
+    u['last_access_date'] = u['last_access_date'].isoformat()
+    return u
+
+def stream_users(conn, ids, outp, batch_size):
+    """
+    Queries the users in sorted batches of ids over the given connection (a single one, reused by every batch,
+    not a pool), writing one JSON line per user. Returns the number of users
+    """
+    written = 0
+    with conn.cursor() as cur:
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size].tolist()
+            with metrics.time('db_fetch'):
+                rows = cur.execute(f"""SELECT {', '.join(cols)} FROM users
+                                WHERE id = ANY(%s);
+                            """, (batch,)).fetchall()
+            with metrics.time('json_encode'):
+                for u in rows:
+                    json.dump(treat_user(u), outp)
+                    outp.write('\n')
+            written += len(rows)
+            metrics.count('users', len(rows))
+    return written
+
 if __name__ == '__main__':
     args = parse_args()
-    ids = set()
-    with open(args.i, 'r') as inp:
-        for line in inp:
-            obj = json.loads(line)
-            get_ids(obj, ids)
-
-    ids.remove(None)
-    print(f"Parsed {len(ids)} unique user ids")
-
-    #Pull the user data
-    conn = psy.connect("dbname=stackoverflow user=postgres", row_factory=dict_row)
-    cur = conn.cursor(name='cur')
-
-    cols = ['id', 'reputation', 'location', 'views', 'up_votes', 'down_votes', 'creation_date', 'last_access_date']
-    query = cur.execute(f"""SELECT {', '.join(cols)} FROM users
-                            WHERE id = ANY(%s);
-                        """, (list(ids),))
-    
-    with open(args.o, 'w') as outp:
-        users = query.fetchall()
-
-        for u in users:
-            #Convert time
-            u['creation_date'] = u['creation_date'].isoformat()
-            u['last_access_date'] = u['last_access_date'].isoformat()
-        #Index by id
-        users = {u['id']: u for u in users}
-        json.dump(users, outp, indent=1)
-
-    cur.close()
-    conn.close()
\ No newline at end of file
+    configure_from_args(args)
+
+    if args.chunked:
+        ids = collect_ids(args.i).sorted()
+        print(f"Parsed {len(ids)} unique user ids")
+
+        with psy.connect(DSN, row_factory=dict_row) as conn:
+            with open_jsonl(args.o, 'w') as outp:
+                written = stream_users(conn, ids, outp, args.batch_size)
+        print(f"Wrote {written} users")
+    else:
+        ids = set()
+        with open_jsonl(args.i, 'rb') as inp:
+            for line in inp:
+                obj = loads(line)
+                get_ids(obj, ids)
+
+        ids.remove(None)
+        print(f"Parsed {len(ids)} unique user ids")
+
+        #Pull the user data
+        conn = psy.connect(DSN, row_factory=dict_row)
+        cur = conn.cursor(name='cur')
+
+        query = cur.execute(f"""SELECT {', '.join(cols)} FROM users
+                                WHERE id = ANY(%s);
+                            """, (list(ids),))
+        
+        with open_jsonl(args.o, 'w') as outp:
+            with metrics.time('db_fetch'):
+                users = query.fetchall()
+            metrics.count('users', len(users))
+
+            for u in users:
+                treat_user(u)
+            #Index by id
+            users = {u['id']: u for u in users}
+            json.dump(users, outp, indent=1)
+
+        cur.close()
+        conn.close()
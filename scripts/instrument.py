@@ -0,0 +1,186 @@
+import atexit
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing.util import Finalize
+
+#Latency buckets grow by 2^(1/4) (~19%) from 1 microsecond, so percentiles are within one bucket
+BUCKET_BASE = 2 ** 0.25
+BUCKET_MIN = 1e-6
+
+def add_metrics_args(parser):
+    '''Options shared by every script that reports metrics'''
+    parser.add_argument('--metrics', type=str, default=None, help='Append periodic counters/latency snapshots to this JSONL file')
+    parser.add_argument('--metrics-every', type=float, default=30, help='Seconds between metrics snapshots')
+    parser.add_argument('--profile-interval', type=float, default=None,
+                        help='Sample the main thread stack every N seconds and report the hottest frames')
+
+class Histogram:
+    '''Log-bucketed latency histogram (seconds)'''
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[max(0, math.ceil(math.log(max(seconds, BUCKET_MIN) / BUCKET_MIN, BUCKET_BASE)))] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        'Upper bound of the bucket holding the q-th percentile'
+        rank, seen = q / 100 * self.count, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(BUCKET_MIN * BUCKET_BASE ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'total': round(self.total, 6), 'mean': round(self.total / self.count, 6) if self.count else None,
+                'p50': round(self.percentile(50), 6), 'p90': round(self.percentile(90), 6),
+                'p99': round(self.percentile(99), 6), 'max': round(self.max, 6)}
+
+class SamplingProfiler:
+    '''Samples the stack of one thread at a fixed interval, counting the innermost frames and whole stacks'''
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.leaves = Counter()
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.samples += 1
+            self.leaves[f'{stack[0]}'] += 1
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+
+    def summary(self, top=20):
+        'Hottest innermost functions and stacks (collapsed, flamegraph style), as fractions of the samples'
+        n = max(self.samples, 1)
+        return {'samples': self.samples,
+                'top_frames': [[f, round(c / n, 4)] for f, c in self.leaves.most_common(top)],
+                'top_stacks': [[s, round(c / n, 4)] for s, c in self.stacks.most_common(top)]}
+
+class Metrics:
+    '''
+    Counters and latency histograms for the stages of a script. Until `configure` is called with a path,
+    values are only collected in memory; afterwards a snapshot with the totals, per-second rates (overall
+    and since the previous snapshot), latency percentiles and profiler samples is appended every `every` seconds.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+        self.start = self.last_time = time.time()
+        self.last_counters = Counter()
+        self.path = None
+        self.script = os.path.basename(sys.argv[0])
+        self.profiler = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def configure(self, path, every=30, script=None, profile_interval=None):
+        self.path = path
+        self.script = script or self.script
+        if profile_interval:
+            self.profiler = SamplingProfiler(profile_interval)
+            self.profiler.start()
+        if path is not None:
+            self.thread = threading.Thread(target=self.run, args=(every,), daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+    @contextmanager
+    def time(self, name):
+        'Records the duration of the block in the `name` histogram'
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            interval = max(now - self.last_time, 1e-9)
+            elapsed = max(now - self.start, 1e-9)
+            snap = {'time': datetime.now().isoformat(timespec='seconds'), 'script': self.script, 'pid': os.getpid(),
+                    'elapsed': round(elapsed, 3), 'counters': dict(self.counters),
+                    'rates': {k: round(v / elapsed, 2) for k, v in self.counters.items()},
+                    'recent_rates': {k: round((v - self.last_counters[k]) / interval, 2) for k, v in self.counters.items()},
+                    'latency': {k: h.summary() for k, h in self.histograms.items()}}
+            self.last_time, self.last_counters = now, Counter(self.counters)
+        if self.profiler is not None:
+            snap['profile'] = self.profiler.summary()
+        return snap
+
+    def emit(self):
+        if self.path is None:
+            return
+        snap = self.snapshot()
+        with open(self.path, 'a') as outp:
+            outp.write(json.dumps(snap) + '\n')
+
+    def run(self, every):
+        while not self.stopped.wait(every):
+            self.emit()
+
+    def close(self):
+        'Stops the periodic thread and the profiler, writing a last snapshot'
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.emit()
+
+metrics = Metrics()
+
+def configure_from_args(args, suffix=''):
+    '''Configures the shared `metrics` from add_metrics_args options. Worker processes pass a suffix for their own file'''
+    path = args.metrics + suffix if args.metrics else None
+    metrics.configure(path, args.metrics_every, profile_interval=args.profile_interval)
+
+def init_worker_metrics(args):
+    '''
+    Pool initializer: gives each worker process its own metrics file (path + '.worker{pid}'). Pool workers skip atexit,
+    so the last snapshot is written by a finalizer, which runs when the pool is closed and joined (not terminated)
+    '''
+    configure_from_args(args, f'.worker{os.getpid()}')
+    Finalize(None, metrics.close, exitpriority=10)
@@ -0,0 +1,95 @@
+import gzip
+import io
+import json
+
+#Optional: zstd (de)compression and a faster JSON decoder
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BUFFER_SIZE = 1 << 20
+#Kind of a text in the binary side files (tokens, probabilities, lemmas): a question or answer body, or a comment
+POST, COMMENT = 0, 1
+COMPRESSIONS = {'.zst': 'zstd', '.zstd': 'zstd', '.gz': 'gzip'}
+
+def compression_of(path: str):
+    'zstd, gzip or None, from the file extension'
+    for ext, name in COMPRESSIONS.items():
+        if path.endswith(ext):
+            return name
+    return None
+
+def strip_compression(path: str):
+    'The path without its compression extension, e.g. dump.jsonl.zst -> dump.jsonl'
+    for ext in COMPRESSIONS:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+def with_suffix(path: str, suffix: str):
+    'Inserts a suffix before the compression extension: (dump.jsonl.zst, .2014) -> dump.jsonl.2014.zst'
+    base = strip_compression(path)
+    return base + suffix + path[len(base):]
+
+def open_jsonl(path: str, mode: str = 'r', level: int = 3, buffer_size: int = BUFFER_SIZE):
+    '''
+    Opens a (JSONL) file like `open`, with large buffers, (de)compressing .zst and .gz files transparently.
+    Modes are r/w/a, text unless 'b' is given. Compressed files are streams: they cannot seek.
+    '''
+    binary = 'b' in mode
+    kind = mode.replace('b', '').replace('t', '')
+    compression = compression_of(path)
+
+    if compression is None:
+        return open(path, kind + ('b' if binary else ''), buffering=buffer_size,
+                    **({} if binary else {'encoding': 'utf-8', 'newline': '\n' if kind != 'r' else None}))
+
+    if compression == 'gzip':
+        stream = gzip.open(path, kind + 'b', compresslevel=level)
+        stream = io.BufferedReader(stream, buffer_size) if kind == 'r' else io.BufferedWriter(stream, buffer_size)
+    else:
+        if zstandard is None:
+            raise ImportError(f'Reading or writing {path} needs the zstandard package')
+        raw = open(path, kind + 'b')
+        if kind == 'r':
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), buffer_size)
+        else:
+            #Appending adds a new frame, concatenated frames are still a valid zstd file
+            stream = io.BufferedWriter(zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=True), buffer_size)
+
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='\n' if kind != 'r' else None)
+
+def loads(line):
+    'Parses a JSON line (str or bytes), with orjson when available. Gives the same objects as json.loads'
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass #e.g. lone surrogates or huge ints, which json accepts
+    return json.loads(line)
+
+def dumps(obj):
+    'One JSONL line, byte-identical to json.dump(obj, f) followed by a newline'
+    return json.dumps(obj) + '\n'
+
+def read_jsonl(path: str):
+    'Yields the object of every line'
+    with open_jsonl(path, 'rb') as inp:
+        for line in inp:
+            yield loads(line)
+
+def write_jsonl(path: str, objs, level: int = 3):
+    'Writes objects one per line, returning how many were written'
+    n = 0
+    with open_jsonl(path, 'w', level) as outp:
+        for obj in objs:
+            outp.write(dumps(obj))
+            n += 1
+    return n
@@ -1,64 +1,112 @@
 import argparse
 import json
+import os
 import psycopg as psy
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from instrument import add_metrics_args, configure_from_args, metrics
+from jsonl_io import open_jsonl, loads, strip_compression
 from psycopg.rows import dict_row
 
+DSN = "dbname=stackoverflow user=postgres"
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-i', type=str, help='Path to user_dump', required=True)
     parser.add_argument('-o', type=str, help='Output file', required=True)
+    parser.add_argument('--state', type=str, default=None,
+                        help='Incremental state (watermark + last interaction per user). Only rows newer than the watermark are scanned')
+    parser.add_argument('--concurrent', action='store_true', help='Run the comments and posts aggregations on separate connections at once')
+    add_metrics_args(parser)
 
     return parser.parse_args()
 
-i = 0
+def load_users(path):
+    """Loads the user dump, either the JSON dict or the JSONL written by `get_users.py --chunked`"""
+    with open_jsonl(path, 'r') as inp:
+        if strip_compression(path).endswith('.jsonl'):
+            return {str(u['id']): u for u in map(loads, inp)}
+        return json.load(inp)
+
+def load_state(path):
+    if path is None or not os.path.exists(path):
+        return {'watermark': None, 'last': {}}
+    with open(path, 'r') as inp:
+        return json.load(inp)
+
+def save_state(path, state):
+    with open(path + '.tmp', 'w') as outp:
+        json.dump(state, outp)
+    os.replace(path + '.tmp', path)
+
+def latest_by_user(table, user_col, ids, lower=None, upper=None):
+    """MAX(creation_date) per user of `table`, only over rows in (lower, upper] when given. Uses its own connection"""
+    if not ids:
+        return {}
+
+    conditions, params = [f'{user_col} = ANY(%s)'], [ids]
+    if lower is not None:
+        conditions.append('creation_date > %s')
+        params.append(lower)
+    if upper is not None:
+        conditions.append('creation_date <= %s')
+        params.append(upper)
+
+    with psy.connect(DSN, row_factory=dict_row) as conn:
+        cur = conn.cursor(name=f'{table}_cur')
+        with metrics.time(f'db_{table}'):
+            rows = cur.execute(f"""SELECT {user_col}, MAX(creation_date) FROM {table}
+                            WHERE {' AND '.join(conditions)}
+                            GROUP BY {user_col};
+                        """, params).fetchall()
+        cur.close()
+        metrics.count(f'{table}_users', len(rows))
+
+    print(f"Finished {table}")
+    return {str(r[user_col]): r['max'] for r in rows}
+
+def current_watermark():
+    """Newest creation_date over comments and posts, read before aggregating so that later rows are left for the next run"""
+    with psy.connect(DSN) as conn:
+        row = conn.execute("""SELECT GREATEST((SELECT MAX(creation_date) FROM comments),
+                                              (SELECT MAX(creation_date) FROM posts))""").fetchone()
+    return row[0]
+
 if __name__ == '__main__':
     args = parse_args()
-    ids = set()
-    with open(args.i, 'r') as inp:
-        data = json.load(inp)
-
-    conn = psy.connect("dbname=stackoverflow user=postgres", row_factory=dict_row)
-    cur = conn.cursor(name='cur')
-
-    ids = list(data.keys())
-
-    comments = cur.execute(f"""SELECT user_id, MAX(creation_date) FROM comments
-                    WHERE user_id = ANY(%s)
-                    GROUP BY user_id;
-                """, (ids,)).fetchall()
-    
-    print("Finished comments")
-    
-    posts = cur.execute(f"""SELECT owner_user_id, MAX(creation_date) FROM posts
-                    WHERE owner_user_id = ANY(%s)
-                    GROUP BY owner_user_id;
-                """, (ids,)).fetchall()
-
-    print("Finished posts")
-
-    #Transform post and comments to dictionaries
-    c_indexed = {}
-    for c in comments:
-        c_indexed[str(c['user_id'])] = c['max']
-    p_indexed = {}
-    for p in posts:
-        p_indexed[str(p['owner_user_id'])] = p['max']
+    configure_from_args(args)
+    data = load_users(args.i)
+    state = load_state(args.state)
+
+    watermark = datetime.fromisoformat(state['watermark']) if state['watermark'] else None
+    upper = current_watermark() if args.state else None
+
+    #Users already in the state only need rows newer than the watermark, new users need a full scan
+    known = [int(i) for i in data if i in state['last']] if watermark is not None else []
+    new = [int(i) for i in data if watermark is None or i not in state['last']]
+    jobs = [('comments', 'user_id', new, None), ('posts', 'owner_user_id', new, None)]
+    if known:
+        jobs += [('comments', 'user_id', known, watermark), ('posts', 'owner_user_id', known, watermark)]
+
+    with ThreadPoolExecutor(len(jobs) if args.concurrent else 1) as pool:
+        results = list(pool.map(lambda job: latest_by_user(*job, upper), jobs))
+
+    #Merge the previous last interactions with the new maxima
+    last = {i: datetime.fromisoformat(d) for i, d in state['last'].items() if d is not None and i in data}
+    for result in results:
+        for i, d in result.items():
+            if i not in last or d > last[i]:
+                last[i] = d
 
     #Add the interactions
     for id, user in data.items():
-        #print(id)
-        if id in p_indexed and id in c_indexed:
-            user['last_interaction'] = max(p_indexed[id], c_indexed[id]).isoformat()
-        elif id in p_indexed:
-            user['last_interaction'] = p_indexed[id].isoformat()
-        elif id in c_indexed:
-            user['last_interaction'] = c_indexed[id].isoformat()
-        else:
-            user['last_interaction'] = None
-    
-    with open(args.o, 'w') as outp:
+        user['last_interaction'] = last[id].isoformat() if id in last else None
+
+    with open_jsonl(args.o, 'w') as outp:
         json.dump(data, outp, indent=1)
 
-    cur.close()
-    conn.close()
\ No newline at end of file
+    #Every user is recorded, also those without any interaction, so that they are not rescanned as new users
+    if args.state:
+        save_state(args.state, {'watermark': upper.isoformat() if upper else state['watermark'],
+                                'last': {id: user['last_interaction'] for id, user in data.items()}})
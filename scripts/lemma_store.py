@@ -0,0 +1,25 @@
+import json
+import os
+import numpy as np
+
+#One record per lemmatized text. Its lemma ids are tokens[start:start + length], ids index vocab.json
+DOC_DTYPE = np.dtype([('kind', 'u1'), ('id', '<i8'), ('sentiment', 'i1'), ('start', '<i8'), ('length', '<i4')])
+TOKEN_DTYPE = np.dtype('<i4')
+
+def load_lemmas(path: str):
+    '''
+    Lazily maps a lemmatized output directory written by lemmatizer.py. Returns (docs, tokens, vocab):
+    the DOC_DTYPE records (sentiment is -1 when missing), the flat int32 lemma ids and the id -> lemma list.
+    '''
+    docs_path, tokens_path = os.path.join(path, 'docs.bin'), os.path.join(path, 'tokens.bin')
+    #np.memmap refuses empty files, as in token_store
+    docs = np.memmap(docs_path, dtype=DOC_DTYPE, mode='r') if os.path.getsize(docs_path) else np.empty(0, dtype=DOC_DTYPE)
+    tokens = np.memmap(tokens_path, dtype=TOKEN_DTYPE, mode='r') if os.path.getsize(tokens_path) else np.empty(0, dtype=TOKEN_DTYPE)
+    with open(os.path.join(path, 'vocab.json'), 'r') as inp:
+        vocab = json.load(inp)
+    return docs, tokens, vocab
+
+def doc_lemmas(docs, tokens, vocab, i: int):
+    'Lemmas of document i, as strings'
+    start, length = int(docs[i]['start']), int(docs[i]['length'])
+    return [vocab[t] for t in tokens[start:start + length]]
@@ -0,0 +1,113 @@
+from jsonl_io import POST, COMMENT
+from lemma_store import DOC_DTYPE, TOKEN_DTYPE
+from text_cache import TextCache, get_or_compute
+import argparse
+import json
+import numpy as np
+import os
+import spacy
+import time
+from datetime import timedelta
+
+#Only lemma_ is used: the parser, NER and sentence splitter are never loaded.
+#Rule-based lemmatizers (e.g. en_core_web_sm) still need tok2vec, tagger and attribute_ruler
+EXCLUDE = ['parser', 'ner', 'senter']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Lemmatizes every post, answer and comment into compact lemma id files')
+
+    parser.add_argument('-i', type=str, help='Input JSONL file (cleaned or analyzed)', required=True)
+    parser.add_argument('-o', type=str, help='Output directory (docs.bin, tokens.bin, vocab.json)', default='./lemmatized')
+    parser.add_argument('--model', type=str, default='en_core_web_sm', help='spaCy pipeline name or path')
+    parser.add_argument('--exclude', type=str, default=','.join(EXCLUDE), help='Comma separated pipeline components not to load')
+    parser.add_argument('--processes', type=int, default=1, help='nlp.pipe processes')
+    parser.add_argument('--batch-size', type=int, default=1024, help='nlp.pipe batch size')
+    parser.add_argument('--chunk-docs', type=int, default=100000, help='Texts gathered before each nlp.pipe call')
+    parser.add_argument('--cache', type=str, default=None, help='SQLite file caching lemmas by text + pipeline')
+
+    return parser.parse_args()
+
+class LemmaCache(TextCache):
+    '''Persistent text -> lemmas cache in SQLite, keyed by a hash of the text plus the pipeline identity'''
+    table = 'lemmas'
+    columns = {'lemmas': 'TEXT NOT NULL'}
+
+    def encode(self, lemmas):
+        return (json.dumps(lemmas),)
+
+    def decode(self, row):
+        return json.loads(row[0])
+
+def pipeline_identity(name: str, nlp):
+    'Model name, versions and the components actually loaded, since --exclude can change the lemmas'
+    return f"{name}|{nlp.meta.get('version')}|spacy={spacy.__version__}|{','.join(nlp.pipe_names)}"
+
+def collect_docs(obj, docs):
+    'Appends (text, kind, id, sentiment) of the post, its comments, its answers and their comments'
+    def add(item, text_key, sentiment_key, kind):
+        sentiment = item.get(sentiment_key)
+        docs.append((item[text_key], kind, item['id'], -1 if sentiment is None else sentiment))
+
+    add(obj, 'body', 'body_sentiment', POST)
+    for c in obj['comments']:
+        add(c, 'text', 'text_sentiment', COMMENT)
+    for a in obj['answers']:
+        add(a, 'body', 'body_sentiment', POST)
+        for c in a['comments']:
+            add(c, 'text', 'text_sentiment', COMMENT)
+
+class Lemmatizer:
+    '''Lemmatizes chunks of texts, running the pipeline once per distinct text that is not cached'''
+    def __init__(self, args):
+        self.nlp = spacy.load(args.model, exclude=[c for c in args.exclude.split(',') if c])
+        self.processes = args.processes
+        self.batch_size = args.batch_size
+        self.cache = LemmaCache(args.cache, pipeline_identity(args.model, self.nlp)) if args.cache else None
+
+    def lemmatize(self, texts: list):
+        'Runs the pipeline once per distinct text that is not cached'
+        return get_or_compute(self.cache, texts, lambda missing: [
+            [tok.lemma_ for tok in doc] for doc in self.nlp.pipe(missing, n_process=self.processes, batch_size=self.batch_size)])
+
+def write_chunk(lemmatizer, docs, vocab, docs_out, tokens_out, start):
+    'Lemmatizes a chunk of docs and appends their records and lemma ids. Returns the next token offset'
+    lemmas = lemmatizer.lemmatize([d[0] for d in docs])
+    records = np.empty(len(docs), dtype=DOC_DTYPE)
+    ids = []
+    for i, ((_, kind, id, sentiment), doc_lemmas) in enumerate(zip(docs, lemmas)):
+        records[i] = (kind, id, sentiment, start + len(ids), len(doc_lemmas))
+        ids.extend(vocab.setdefault(l, len(vocab)) for l in doc_lemmas)
+
+    docs_out.write(records.tobytes())
+    tokens_out.write(np.array(ids, dtype=TOKEN_DTYPE).tobytes())
+    return start + len(ids)
+
+if __name__ == '__main__':
+    args = parse_args()
+    lemmatizer = Lemmatizer(args)
+    os.makedirs(args.o, exist_ok=True)
+
+    vocab = {}
+    docs, start, lines, texts = [], 0, 0, 0
+    start_time = time.time()
+    with open(args.i, 'r') as inp, open(os.path.join(args.o, 'docs.bin'), 'wb') as docs_out, \
+         open(os.path.join(args.o, 'tokens.bin'), 'wb') as tokens_out:
+        for line in inp:
+            collect_docs(json.loads(line), docs)
+            lines += 1
+            if len(docs) >= args.chunk_docs:
+                start = write_chunk(lemmatizer, docs, vocab, docs_out, tokens_out, start)
+                texts += len(docs)
+                docs = []
+                print(f"{lines} lines, {texts} texts | {texts / (time.time() - start_time):.1f} texts/sec")
+        if docs:
+            start = write_chunk(lemmatizer, docs, vocab, docs_out, tokens_out, start)
+            texts += len(docs)
+
+    with open(os.path.join(args.o, 'vocab.json'), 'w') as outp:
+        json.dump(list(vocab), outp)
+
+    print(f"Lemmatized {texts} texts ({start} tokens, {len(vocab)} lemmas) in {timedelta(seconds=int(time.time() - start_time))}")
+    if lemmatizer.cache is not None:
+        print(lemmatizer.cache.stats())
+        lemmatizer.cache.close()
@@ -0,0 +1,235 @@
+import classifier
+import cleaner
+from instrument import add_metrics_args, configure_from_args
+from jsonl_io import open_jsonl, loads, dumps
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from multiprocessing import Pool
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Streaming raw dump -> clean -> classify -> analyzed JSONL pipeline. '
+                                     'Pre-tokenized shards cannot be used here, as they are keyed by the ids of an already '
+                                     'cleaned file: for those run cleaner.py, pretokenize.py and classifier.py --tokens')
+
+    parser.add_argument('-i', type=str, help='Raw dump JSONL file (converter.py output)', required=True)
+    parser.add_argument('-o', type=str, help='Output JSONL file', default='./analyzed.jsonl')
+    parser.add_argument('--cleaned', type=str, default=None, help='Optionally also write the cleaned JSONL here')
+    parser.add_argument('--clean-workers', type=int, default=2, help='Cleaning processes (0 cleans in a thread)')
+    parser.add_argument('--parser', type=str, choices=cleaner.PARSERS, default='html.parser', help='BeautifulSoup parser')
+    parser.add_argument('--chunk-lines', type=int, default=256, help='Lines per chunk moving between stages')
+    parser.add_argument('--queue-chunks', type=int, default=8, help='Chunks each queue holds before blocking its producer')
+    parser.add_argument('--report-every', type=float, default=30, help='Seconds between stage reports')
+    classifier.add_model_args(parser)
+    parser.add_argument('--per-text', action='store_true', help='Classify one text at a time instead of length-bucketed batches')
+    add_metrics_args(parser)
+
+    return parser.parse_args()
+
+class StageStats:
+    '''
+    Counters for one pipeline stage. Time is split between working, waiting on the upstream queue
+    (starved) and waiting on the downstream queue (blocked, i.e. backpressure).
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.lines = 0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.start = time.time()
+        self.end = None
+
+    def finish(self):
+        self.end = time.time()
+
+    def elapsed(self):
+        return max((self.end or time.time()) - self.start, 1e-9)
+
+    def get(self, q):
+        start = time.time()
+        item = q.get()
+        self.starved += time.time() - start
+        return item
+
+    def put(self, q, item, consumer=None):
+        '''
+        Puts an item on the downstream queue. Given the consumer thread, gives up and returns False
+        if it has died while the queue is full, instead of blocking forever.
+        '''
+        start = time.time()
+        try:
+            while True:
+                try:
+                    q.put(item, timeout=None if consumer is None else 0.5)
+                    return True
+                except queue.Full:
+                    if not consumer.is_alive():
+                        return False
+        finally:
+            self.blocked += time.time() - start
+
+    def work_time(self):
+        return max(self.elapsed() - self.starved - self.blocked, 0)
+
+    def busy(self):
+        'Fraction of the time spent working'
+        return self.work_time() / self.elapsed()
+
+    def report(self):
+        elapsed = self.elapsed()
+        return (f"{self.name}: {self.lines} lines, {self.lines / elapsed:.1f} lines/sec | "
+                f"busy {self.busy() * 100:.0f}%, starved {self.starved / elapsed * 100:.0f}%, "
+                f"blocked {self.blocked / elapsed * 100:.0f}%")
+
+def clean_chunk(lines):
+    'Worker side of the cleaning stage: raw lines -> cleaned post objects'
+    posts = []
+    for line in lines:
+        obj = loads(line)
+        cleaner.clean_post(obj)
+        posts.append(obj)
+    return posts
+
+def read_stage(path, chunk_lines, out_q, stats):
+    with open_jsonl(path, 'r') as inp:
+        chunk = []
+        for line in inp:
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                stats.lines += len(chunk)
+                stats.put(out_q, chunk)
+                chunk = []
+        if chunk:
+            stats.lines += len(chunk)
+            stats.put(out_q, chunk)
+
+def clean_stage(in_q, out_q, pool, max_inflight, cleaned_path, stats):
+    '''Cleans chunks in the pool, keeping at most max_inflight chunks in flight and the output in input order'''
+    inflight = deque()
+    outp = open_jsonl(cleaned_path, 'w') if cleaned_path else None
+
+    def emit(posts):
+        if outp is not None:
+            outp.writelines(map(dumps, posts))
+        stats.lines += len(posts)
+        stats.put(out_q, posts)
+
+    try:
+        while True:
+            chunk = stats.get(in_q)
+            if chunk is None:
+                break
+            if pool is None:
+                emit(clean_chunk(chunk))
+                continue
+
+            inflight.append(pool.apply_async(clean_chunk, (chunk,)))
+            if len(inflight) >= max_inflight:
+                emit(inflight.popleft().get())
+
+        while inflight:
+            emit(inflight.popleft().get())
+    finally:
+        if outp is not None:
+            outp.close()
+
+def write_stage(path, in_q, stats):
+    with open_jsonl(path, 'w') as outp:
+        while True:
+            posts = stats.get(in_q)
+            if posts is None:
+                break
+            outp.writelines(map(dumps, posts))
+            stats.lines += len(posts)
+
+def run_stage(target, args, stats, out_q, errors):
+    '''Runs a stage in the current thread, always sending the end-of-stream marker downstream'''
+    try:
+        target(*args, stats)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        stats.finish()
+        if out_q is not None:
+            out_q.put(None)
+
+def run_pipeline(args):
+    raw_q = queue.Queue(args.queue_chunks)
+    clean_q = queue.Queue(args.queue_chunks)
+    out_q = queue.Queue(args.queue_chunks)
+    stages = [StageStats(n) for n in ['read', 'clean', 'classify', 'write']]
+    read_stats, clean_stats, classify_stats, write_stats = stages
+    errors = []
+
+    #Fork the cleaning workers before the model is loaded
+    cleaner.set_parser(args.parser)
+    pool = Pool(args.clean_workers, initializer=cleaner.init_worker, initargs=(args.parser, args)) if args.clean_workers > 0 else None
+    classifier.load_model(args)
+    classifier.open_cache(args)
+    configure_from_args(args)
+
+    threads = [
+        threading.Thread(target=run_stage, args=(read_stage, (args.i, args.chunk_lines, raw_q), read_stats, raw_q, errors)),
+        threading.Thread(target=run_stage, args=(clean_stage, (raw_q, clean_q, pool, args.queue_chunks, args.cleaned), clean_stats, clean_q, errors)),
+        threading.Thread(target=run_stage, args=(write_stage, (args.o, out_q), write_stats, None, errors)),
+    ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    start_time = time.time()
+    last_report = start_time
+    texts = 0
+    finished = False
+    try:
+        #The model runs in the main thread, between the cleaning and writing stages
+        while True:
+            posts = classify_stats.get(clean_q)
+            if posts is None or errors:
+                break
+            targets, _ = classifier.classify_posts(posts, args.max_tokens, not args.per_text)
+            texts += len(targets)
+            classify_stats.lines += len(posts)
+            #Stops if the writer died, rather than waiting on its full queue
+            if not classify_stats.put(out_q, posts, threads[2]):
+                break
+
+            if time.time() - last_report >= args.report_every:
+                last_report = time.time()
+                print(f"Elapsed: {timedelta(seconds=int(last_report - start_time))} | {texts} texts | "
+                      f"queues raw {raw_q.qsize()}/{args.queue_chunks}, clean {clean_q.qsize()}/{args.queue_chunks}, "
+                      f"out {out_q.qsize()}/{args.queue_chunks}")
+                for s in stages:
+                    print(f'  {s.report()}')
+        finished = not errors
+    finally:
+        classify_stats.finish()
+        classify_stats.put(out_q, None, threads[2])
+        threads[2].join()
+        #After a failure, upstream stages may be blocked on a full queue: leave those daemon threads behind
+        if finished:
+            threads[0].join()
+            threads[1].join()
+        if pool is not None:
+            pool.close() if finished else pool.terminate()
+            pool.join()
+
+    if errors:
+        raise errors[0]
+    if classifier.cache is not None:
+        classifier.cache.commit()
+        print(classifier.cache.stats())
+
+    total_time = time.time() - start_time
+    print(f"\nProcessed {write_stats.lines} lines ({texts} texts) in {timedelta(seconds=int(total_time))}")
+    for s in stages:
+        print(f'  {s.report()}')
+    #The stage that spent the most time actually working limits the throughput
+    print(f"Bottleneck: {max(stages, key=StageStats.work_time).name}")
+
+if __name__ == '__main__':
+    run_pipeline(parse_args())
@@ -0,0 +1,100 @@
+from classifier import MODEL, collect_texts, shard_ranges
+from jsonl_io import POST, COMMENT, open_jsonl, loads, compression_of
+from token_store import DOC_DTYPE, TOKEN_DTYPE, shard_paths
+from transformers import AutoTokenizer
+import argparse
+import json
+import multiprocessing as mp
+import numpy as np
+import os
+import time
+from datetime import timedelta
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Tokenizes every question, answer and comment once into memory-mapped token id shards')
+
+    parser.add_argument('-i', type=str, help='Input JSONL file (cleaned)', required=True)
+    parser.add_argument('-o', type=str, help='Output directory (meta.json, shard*.docs.bin, shard*.tokens.bin)', default='./tokenized')
+    parser.add_argument('--model', type=str, help='Model name or local path whose tokenizer is used', default=MODEL)
+    parser.add_argument('--max-length', type=int, default=512, help='Truncation length, as in classifier.py')
+    parser.add_argument('--chunk-lines', type=int, default=1000, help='JSONL lines tokenized per tokenizer call')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes, each writing its own shard')
+
+    return parser.parse_args()
+
+def write_chunk(tokenizer, chunk, max_length, docs_out, tokens_out, start):
+    'Tokenizes the texts of a chunk of posts and appends their records and input ids. Returns the next token offset'
+    targets = []
+    for post in chunk:
+        collect_texts(post, targets)
+    encoded = tokenizer([t[2] for t in targets], truncation=True, max_length=max_length)['input_ids']
+
+    records = np.empty(len(targets), dtype=DOC_DTYPE)
+    records['kind'] = [POST if key == 'body_sentiment' else COMMENT for _, key, _ in targets]
+    records['id'] = [obj['id'] for obj, _, _ in targets]
+    records['length'] = [len(e) for e in encoded]
+    records['start'] = start + np.cumsum(records['length']) - records['length']
+
+    docs_out.write(records.tobytes())
+    tokens_out.write(np.fromiter((t for e in encoded for t in e), dtype=TOKEN_DTYPE).tobytes())
+    return start + int(records['length'].sum())
+
+def tokenize_shard(job):
+    '''Tokenizes the lines starting within [start, end) of the input into shard k. Returns (lines, texts, tokens)'''
+    k, start, end, args = job
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    docs_path, tokens_path = shard_paths(args.o, k)
+    lines, texts, tokens = 0, 0, 0
+    chunk = []
+
+    def flush():
+        nonlocal texts, tokens, chunk
+        before = docs_out.tell()
+        tokens = write_chunk(tokenizer, chunk, args.max_length, docs_out, tokens_out, tokens)
+        texts += (docs_out.tell() - before) // DOC_DTYPE.itemsize
+        chunk = []
+
+    with open_jsonl(args.i, 'rb') as inp, open(docs_path, 'wb') as docs_out, open(tokens_path, 'wb') as tokens_out:
+        pos = start
+        if start:
+            inp.seek(start)
+        for line in inp:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            chunk.append(loads(line))
+            lines += 1
+            if len(chunk) >= args.chunk_lines:
+                flush()
+        if chunk:
+            flush()
+
+    return lines, texts, tokens
+
+if __name__ == '__main__':
+    args = parse_args()
+    start_time = time.time()
+    os.makedirs(args.o, exist_ok=True)
+    if os.path.exists(os.path.join(args.o, 'meta.json')):
+        os.remove(os.path.join(args.o, 'meta.json'))
+
+    #Compressed inputs cannot seek, so they are tokenized into a single shard
+    ranges = [(0, None)] if compression_of(args.i) else shard_ranges(args.i, args.workers)
+    jobs = [(k, s, e, args) for k, (s, e) in enumerate(ranges)]
+    if len(jobs) > 1:
+        with mp.get_context('spawn').Pool(len(jobs)) as pool:
+            results = pool.map(tokenize_shard, jobs, chunksize=1)
+    else:
+        results = [tokenize_shard(jobs[0])]
+
+    lines, texts, tokens = (sum(r[i] for r in results) for i in range(3))
+    #Written last, so an interrupted run is never mistaken for a complete one
+    stat = os.stat(args.i)
+    meta = {'model': args.model, 'max_length': args.max_length, 'shards': len(jobs), 'input': os.path.abspath(args.i),
+            'input_size': stat.st_size, 'input_mtime': stat.st_mtime_ns, 'lines': lines, 'texts': texts, 'tokens': tokens}
+    with open(os.path.join(args.o, 'meta.json.tmp'), 'w') as outp:
+        json.dump(meta, outp)
+    os.replace(os.path.join(args.o, 'meta.json.tmp'), os.path.join(args.o, 'meta.json'))
+
+    print(f"Tokenized {lines} lines, {texts} texts ({tokens} tokens, {len(jobs)} shard(s)) "
+          f"in {timedelta(seconds=int(time.time() - start_time))}")
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+
+#One fixed-size record per classified text: what it is, its post/comment id and its class probabilities
+PROBS_DTYPE = np.dtype([('kind', 'u1'), ('id', '<i8'), ('probs', '<f2', (3,))])
+
+def make_records(kinds, ids, probs):
+    records = np.empty(len(ids), dtype=PROBS_DTYPE)
+    records['kind'] = kinds
+    records['id'] = ids
+    records['probs'] = probs
+    return records
+
+def load_probabilities(path: str):
+    '''
+    Lazily maps a probabilities side file. Each record has `kind` (jsonl_io.POST or COMMENT), `id` and `probs`,
+    the float16 (negative, neutral, positive) softmax scores. Nothing is read until it is indexed.
+    '''
+    #np.memmap refuses empty files, as in token_store
+    return np.memmap(path, dtype=PROBS_DTYPE, mode='r') if os.path.getsize(path) else np.empty(0, dtype=PROBS_DTYPE)
+
+def lookup_probabilities(records, kind: int, ids):
+    '''
+    Returns the probabilities of the given post or comment ids, as an (n, 3) array with NaN rows
+    for ids that are not in the file.
+    '''
+    mask = records['kind'] == kind
+    rec_ids = np.asarray(records['id'][mask])
+    rec_probs = np.asarray(records['probs'][mask])
+    order = np.argsort(rec_ids, kind='stable')
+    rec_ids, rec_probs = rec_ids[order], rec_probs[order]
+
+    ids = np.asarray(ids, dtype=np.int64)
+    pos = np.clip(np.searchsorted(rec_ids, ids), 0, max(len(rec_ids) - 1, 0))
+    result = np.full((len(ids), 3), np.nan, dtype=np.float32)
+    if len(rec_ids):
+        found = rec_ids[pos] == ids
+        result[found] = rec_probs[pos[found]]
+    return result
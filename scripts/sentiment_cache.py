@@ -0,0 +1,32 @@
+import numpy as np
+from text_cache import TextCache
+
+class SentimentCache(TextCache):
+    '''
+    Persistent text -> (label, probabilities) cache, keyed by a hash of the cleaned text plus the model identity.
+    Entries live in a SQLite file, with a bounded in-memory LRU in front of it.
+    '''
+    table = 'sentiment'
+    columns = {'label': 'INTEGER NOT NULL', 'probs': 'BLOB'}
+    #Caches written before probabilities were kept only have labels, those rows count as misses
+    where = 'probs IS NOT NULL'
+
+    def __init__(self, path: str, model_name: str, lru_size: int = 100000, retries: int = 20):
+        super().__init__(path, model_name, lru_size, retries)
+        if 'probs' not in [row[1] for row in self.conn.execute('PRAGMA table_info(sentiment)')]:
+            self.conn.execute('ALTER TABLE sentiment ADD COLUMN probs BLOB')
+
+    def encode(self, value):
+        label, probs = value
+        return int(label), np.asarray(probs, dtype=np.float16).tobytes()
+
+    def decode(self, row):
+        label, probs = row
+        return label, np.frombuffer(probs, dtype=np.float16)
+
+    def put_many(self, items):
+        'Stores (text, label, probabilities) entries'
+        self.put_values((t, (label, probs)) for t, label, probs in items)
+
+    def put(self, text: str, label: int, probs):
+        self.put_many([(text, label, probs)])
@@ -0,0 +1,105 @@
+import asyncio
+import itertools
+import json
+import socket
+
+HOST, PORT = '127.0.0.1', 8765
+
+def split(texts, size):
+    return [texts[i:i + size] for i in range(0, len(texts), size)]
+
+def join_responses(responses, probs):
+    'Concatenates chunk responses (in order) into labels, or (labels, probabilities)'
+    for r in responses:
+        if 'error' in r:
+            raise RuntimeError(f"Sentiment server error: {r['error']}")
+    labels = [l for r in responses for l in r['labels']]
+    return (labels, [p for r in responses for p in r['probs']]) if probs else labels
+
+class SentimentClient:
+    '''
+    Async client of sentiment_server.py. Lists are sent as several concurrent requests of chunk_size
+    texts, so the server can batch them with those of other clients. Use as `async with SentimentClient() as c:`
+    '''
+    def __init__(self, host: str = HOST, port: int = PORT, unix: str = None, chunk_size: int = 256):
+        self.host, self.port, self.unix = host, port, unix
+        self.chunk_size = chunk_size
+        self.ids = itertools.count()
+        self.waiting = {}
+        self.reader = self.writer = self.listener = None
+
+    async def connect(self):
+        if self.unix is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix, limit=1 << 26)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=1 << 26)
+        self.listener = asyncio.create_task(self.listen())
+        return self
+
+    async def listen(self):
+        'Hands every response to the request waiting for its id'
+        try:
+            while line := await self.reader.readline():
+                response = json.loads(line)
+                future = self.waiting.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Sentiment server closed the connection'))
+            self.waiting.clear()
+
+    async def request(self, texts: list, probs: bool = False):
+        'Sends one request and returns its raw response'
+        if self.writer is None:
+            await self.connect()
+        id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[id] = future
+        self.writer.write((json.dumps({'id': id, 'texts': texts, 'probs': probs}) + '\n').encode())
+        await self.writer.drain()
+        return await future
+
+    async def classify(self, texts: list, probs: bool = False):
+        'Labels of the texts in order, or (labels, probabilities) if probs'
+        responses = await asyncio.gather(*(self.request(chunk, probs) for chunk in split(list(texts), self.chunk_size)))
+        return join_responses(responses, probs)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.listener
+            self.reader = self.writer = self.listener = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+def classify_texts(texts, host: str = HOST, port: int = PORT, unix: str = None, probs: bool = False, chunk_size: int = 256):
+    '''
+    Blocking version of SentimentClient.classify, e.g. for `df['predicted'] = classify_texts(df['text'].tolist())`.
+    It uses a plain socket, so it also works inside notebooks, whose event loop is already running.
+    '''
+    chunks = split(list(texts), chunk_size)
+    if unix is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(unix)
+    else:
+        sock = socket.create_connection((host, port))
+
+    with sock, sock.makefile('rb') as inp:
+        #All requests go out first, so the server can batch the whole list
+        sock.sendall(b''.join((json.dumps({'id': k, 'texts': c, 'probs': probs}) + '\n').encode()
+                              for k, c in enumerate(chunks)))
+        responses = {}
+        while len(responses) < len(chunks):
+            line = inp.readline()
+            if not line:
+                raise ConnectionError('Sentiment server closed the connection')
+            response = json.loads(line)
+            responses[response['id']] = response
+
+    return join_responses([responses[k] for k in range(len(chunks))], probs)
@@ -0,0 +1,190 @@
+import classifier
+from instrument import add_metrics_args, configure_from_args, metrics
+from text_cache import get_or_compute
+import argparse
+import asyncio
+import json
+import numpy as np
+import os
+import signal
+import time
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local sentiment classification server, batching the texts of concurrent requests')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on')
+    parser.add_argument('--unix', type=str, default=None, help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--max-wait', type=float, default=10, help='Milliseconds a text may wait for others to join its batch')
+    parser.add_argument('--max-batch', type=int, default=256, help='Texts gathered per micro-batch at most')
+    classifier.add_model_args(parser)
+    add_metrics_args(parser)
+
+    return parser.parse_args()
+
+class MicroBatcher:
+    '''
+    Coalesces the texts submitted by concurrent requests into micro-batches. A batch is closed once it
+    has max_batch texts or its first text has waited max_wait seconds. Cached texts skip the model.
+    Cache lookups and the model run in one worker thread (SQLite connections stay in the thread that
+    opened them), so the event loop keeps accepting requests while a batch is classified.
+    '''
+    def __init__(self, max_wait, max_batch, max_tokens):
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.max_tokens = max_tokens
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+
+    async def submit(self, texts):
+        'Returns the (label, probabilities) of each text, in order'
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in texts]
+        for text, future in zip(texts, futures):
+            self.queue.put_nowait((text, future, time.perf_counter()))
+        return await asyncio.gather(*futures)
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        pending = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(pending) < self.max_batch:
+            if not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return pending
+
+    def classify(self, texts):
+        '''
+        Worker thread side of a batch: the (label, probabilities) of each text, from the cache or the model.
+        Fresh probabilities are rounded to float16 like cached ones, so answers do not depend on the cache state.
+        '''
+        def compute(missing):
+            metrics.count('model_texts', len(missing))
+            scores = classifier.batch_scores(classifier.tokenizer, classifier.model, missing, self.max_tokens)
+            return [(int(np.argmax(s)), s.astype(np.float16)) for s in scores]
+
+        return get_or_compute(classifier.cache, texts, compute)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self.next_batch()
+            texts = [t for t, _, _ in pending]
+            start = time.perf_counter()
+            for _, _, queued in pending:
+                metrics.observe('queue_wait', start - queued)
+            metrics.count('batches')
+            metrics.count('texts', len(texts))
+
+            try:
+                with metrics.time('classify'):
+                    entries = await loop.run_in_executor(self.executor, self.classify, texts)
+            except Exception as e:
+                for _, future, _ in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future, _), entry in zip(pending, entries):
+                if not future.done(): #The client may have gone away
+                    future.set_result(entry)
+
+async def handle_client(batcher, reader, writer):
+    '''
+    JSON lines protocol: each request is {"id": ..., "texts": [...], "probs": false} and is answered with
+    {"id": ..., "labels": [...]} (plus "probs" when asked), or {"id": ..., "error": ...}.
+    Requests on one connection are served concurrently, so responses may come back out of order.
+    '''
+    lock = asyncio.Lock()
+    tasks = set()
+
+    async def serve(request):
+        try:
+            entries = await batcher.submit(request['texts'])
+            response = {'id': request.get('id'), 'labels': [e[0] for e in entries]}
+            if request.get('probs'):
+                response['probs'] = [[float(p) for p in e[1]] for e in entries]
+        except Exception as e:
+            response = {'id': request.get('id'), 'error': f'{type(e).__name__}: {e}'}
+        metrics.count('requests')
+        async with lock:
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+
+    try:
+        while line := await reader.readline():
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                request = {'texts': None}
+            #Checked here, so that one bad request cannot fail the batch it would share with others
+            if not isinstance(request, dict) or not isinstance(request.get('texts'), list) \
+               or not all(isinstance(t, str) for t in request['texts']):
+                async with lock:
+                    writer.write((json.dumps({'id': request.get('id') if isinstance(request, dict) else None,
+                                              'error': 'Requests must be JSON objects with a "texts" list of strings'}) + '\n').encode())
+                    await writer.drain()
+                continue
+            task = asyncio.create_task(serve(request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+def close_cache():
+    if classifier.cache is not None:
+        print(classifier.cache.stats())
+        classifier.cache.close()
+
+async def serve_forever(args):
+    loop = asyncio.get_running_loop()
+    batcher = MicroBatcher(args.max_wait / 1000, args.max_batch, args.max_tokens)
+    #The cache is opened, used and closed only in the batcher's thread
+    await loop.run_in_executor(batcher.executor, classifier.open_cache, args)
+    worker = asyncio.create_task(batcher.run())
+
+    def handler(reader, writer):
+        return handle_client(batcher, reader, writer)
+
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = await asyncio.start_unix_server(handler, args.unix, limit=1 << 26)
+        print(f'Listening on {args.unix}')
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port, limit=1 << 26)
+        print(f'Listening on {args.host}:{args.port}')
+
+    #Stop cleanly on Ctrl+C or kill, so the cache is committed and closed
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with server:
+        await stop.wait()
+    worker.cancel()
+    await loop.run_in_executor(batcher.executor, close_cache)
+    batcher.executor.shutdown()
+    if args.unix is not None and os.path.exists(args.unix):
+        os.remove(args.unix)
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure_from_args(args)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    classifier.load_model(args)
+    asyncio.run(serve_forever(args))
@@ -0,0 +1,130 @@
+import hashlib
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from instrument import metrics
+
+def get_or_compute(cache, texts: list, compute):
+    '''
+    Values of texts, in order. Those in the cache (if any) are read from it, compute is called once with the
+    distinct remaining texts and must return their values in the same order, which are then stored.
+    '''
+    with metrics.time('cache_lookup'):
+        values = cache.get_many(texts) if cache is not None else [None] * len(texts)
+    missing = list(dict.fromkeys(t for t, v in zip(texts, values) if v is None))
+    if missing:
+        found = dict(zip(missing, compute(missing)))
+        if cache is not None:
+            cache.put_values(found.items())
+        values = [found[t] if v is None else v for t, v in zip(texts, values)]
+    return values
+
+class TextCache(ABC):
+    '''
+    Persistent text -> value cache, keyed by a hash of the text plus a model identity (anything that changes
+    the value for the same text). Entries live in a SQLite file, with a bounded in-memory LRU in front of it.
+    Subclasses name the table and its value columns, and convert values to and from rows.
+    '''
+    table = None
+    columns = {} #Value column -> SQL type
+    where = '1' #Extra condition a stored row must meet to count as a hit
+
+    def __init__(self, path: str, model_name: str, lru_size: int = 100000, retries: int = 20):
+        self.model_name = model_name
+        self.lru_size = lru_size
+        self.retries = retries
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        #WAL lets readers and one writer work at the same time. Several worker processes can share the file
+        #because every write is its own short transaction (see write), retried while another process holds the lock
+        self.conn = sqlite3.connect(path, timeout=5)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key BLOB PRIMARY KEY, "
+                          f"{', '.join(f'{c} {t}' for c, t in self.columns.items())})")
+
+    @abstractmethod
+    def encode(self, value):
+        'Value -> tuple of column values'
+
+    @abstractmethod
+    def decode(self, row):
+        'Tuple of column values -> value'
+
+    def key(self, text: str):
+        return hashlib.blake2b(f'{self.model_name}\0{text}'.encode(), digest_size=16).digest()
+
+    def _remember(self, key, entry):
+        self.lru[key] = entry
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get_many(self, texts: list):
+        'Returns the cached value of each text, or None where it is not cached'
+        keys = [self.key(t) for t in texts]
+        entries = [self.lru.get(k) for k in keys]
+
+        missing = list({k for k, e in zip(keys, entries) if e is None})
+        found = {}
+        for i in range(0, len(missing), 500): #Stay under SQLite's parameter limit
+            part = missing[i:i + 500]
+            rows = self.conn.execute(f"SELECT key, {', '.join(self.columns)} FROM {self.table} "
+                                     f"WHERE {self.where} AND key IN ({','.join('?' * len(part))})", part)
+            for k, *row in rows:
+                found[k] = self.decode(row)
+
+        for i, k in enumerate(keys):
+            if entries[i] is None and k in found:
+                entries[i] = found[k]
+            if entries[i] is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(k, entries[i])
+
+        return entries
+
+    def get(self, text: str):
+        return self.get_many([text])[0]
+
+    def put_values(self, items):
+        'Stores (text, value) entries'
+        rows = []
+        for t, value in items:
+            k = self.key(t)
+            row = self.encode(value)
+            self._remember(k, self.decode(row))
+            rows.append((k, *row))
+        self.write(f"INSERT OR REPLACE INTO {self.table} (key, {', '.join(self.columns)}) "
+                   f"VALUES ({', '.join('?' * (len(self.columns) + 1))})", rows)
+
+    def write(self, sql: str, rows: list):
+        '''
+        Runs one write transaction and commits it right away, so the write lock is never held between calls.
+        While another process holds it, retries with backoff instead of failing with "database is locked".
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                with self.conn: #Commits, or rolls back on error
+                    self.conn.executemany(sql, rows)
+                return
+            except sqlite3.OperationalError as e:
+                if attempt == self.retries or not any(w in str(e) for w in ('locked', 'busy')):
+                    raise
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+
+    def commit(self):
+        'Writes are committed as they happen, kept for callers that mark their own checkpoints'
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return f"Cache: {self.hits} hits, {self.misses} misses ({(self.hits / total * 100) if total else 0:.1f}% hit rate)"
@@ -0,0 +1,63 @@
+import json
+import os
+import numpy as np
+
+#One record per pre-tokenized text. Its input ids are tokens[start:start + length] of the same shard
+DOC_DTYPE = np.dtype([('kind', 'u1'), ('id', '<i8'), ('start', '<i8'), ('length', '<i4')])
+TOKEN_DTYPE = np.dtype('<i4')
+
+def shard_paths(path: str, k: int):
+    'docs and tokens files of shard k in a pre-tokenized directory'
+    return os.path.join(path, f'shard{k}.docs.bin'), os.path.join(path, f'shard{k}.tokens.bin')
+
+class TokenStore:
+    '''
+    Lazily mapped output directory of pretokenize.py: meta.json plus, for each shard, its DOC_DTYPE
+    records and flat int32 input ids. Texts are looked up by (kind, id), and their ids are returned
+    as views of the mapped shard, so nothing is copied until a batch is built from them.
+    '''
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json'), 'r') as inp:
+            self.meta = json.load(inp)
+        self.model = self.meta['model']
+        self.max_length = self.meta['max_length']
+        self.docs, self.tokens = [], []
+        for k in range(self.meta['shards']):
+            docs_path, tokens_path = shard_paths(path, k)
+            #np.memmap refuses empty files
+            self.docs.append(np.memmap(docs_path, dtype=DOC_DTYPE, mode='r') if os.path.getsize(docs_path)
+                             else np.empty(0, dtype=DOC_DTYPE))
+            self.tokens.append(np.memmap(tokens_path, dtype=TOKEN_DTYPE, mode='r') if os.path.getsize(tokens_path)
+                               else np.empty(0, dtype=TOKEN_DTYPE))
+        self.keys = None
+
+    def __len__(self):
+        return sum(len(d) for d in self.docs)
+
+    def build_lookup(self):
+        'Sorts the (kind, id) keys of every shard once, for searchsorted lookups'
+        keys = np.concatenate([np.asarray(d['id'], dtype=np.int64) * 2 + d['kind'] for d in self.docs])
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.shard_starts = np.cumsum([0] + [len(d) for d in self.docs])
+
+    def locate(self, kinds, ids):
+        'Global record index of each (kind, id), or -1 where the text is not in the store'
+        if self.keys is None:
+            self.build_lookup()
+        keys = np.asarray(ids, dtype=np.int64) * 2 + np.asarray(kinds, dtype=np.int64)
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.clip(np.searchsorted(self.keys, keys), 0, len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, self.order[pos], -1)
+
+    def record_ids(self, i: int):
+        'Input ids of global record i, a view of the mapped shard'
+        k = int(np.searchsorted(self.shard_starts, i, side='right')) - 1
+        doc = self.docs[k][i - self.shard_starts[k]]
+        start = int(doc['start'])
+        return self.tokens[k][start:start + int(doc['length'])]
+
+    def get_many(self, kinds, ids):
+        'Input ids of each (kind, id), or None where the text is not in the store'
+        return [self.record_ids(i) if i >= 0 else None for i in self.locate(kinds, ids)]